@@ -0,0 +1,313 @@
+# ------------------------------------------------------------------------------
+# Name:        benchmark_cityworks.py
+# Purpose:     Load test connect_to_cityworks.py against a local mock of the
+#              Cityworks services and a fake reporter layer
+#
+# Copyright 2016 Esri
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# ------------------------------------------------------------------------------
+
+from mock_cityworks import MockCityworks
+from threading import Lock
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import path
+import connect_to_cityworks
+import requests
+import random
+import json
+import time
+import re
+
+
+class _Properties(dict):
+    """Layer properties that can be read as keys or attributes, like the
+    PropertyMap returned by the ArcGIS API"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeFeature(object):
+    def __init__(self, attributes, geometry=None):
+        self.attributes = attributes
+        self.geometry = geometry
+
+
+class FakeFeatureSet(object):
+    def __init__(self, features):
+        self.features = features
+
+    def __iter__(self):
+        return iter(self.features)
+
+    def __len__(self):
+        return len(self.features)
+
+
+class FakeAttachments(object):
+    def __init__(self, layer):
+        self._layer = layer
+
+    def get_list(self, oid):
+        with self._layer.timed("ListAttachments"):
+            return [{"id": i, "name": "photo{}.jpg".format(i), "contentType": "image/jpeg",
+                     "size": self._layer.attachment_size} for i in range(1, self._layer.attachment_count + 1)]
+
+
+class FakeReportLayer(object):
+    """In-memory stand-in for a reporter feature layer or comment table.
+    Supports the queries and edits made by connect_to_cityworks.main and
+    records the latency of each call"""
+
+    def __init__(self, url, name, features, relationships=None, attachment_count=0, attachment_size=0,
+                 latency=0.0, stats=None):
+        self.url = url
+        self.properties = _Properties(name=name, objectIdField="objectid", maxRecordCount=2000)
+        if relationships is not None:
+            self.properties["relationships"] = relationships
+        self.attachment_count = attachment_count
+        self.attachment_size = attachment_size
+        self.attachments = FakeAttachments(self)
+        self.latency = latency
+        self.stats = stats if stats is not None else {}
+        self._features = dict((feature["objectid"], feature) for feature in features)
+        self._lock = Lock()
+
+    def timed(self, name):
+        return _Timer(self.stats, name, self.latency, self._lock)
+
+    def _matches(self, where):
+        where = (where or "1=1").strip()
+        equals = re.match(r"^(\w+)\s*=\s*'(.*)'$", where)
+        contains = re.match(r"^(\w+)\s+IN\s+\((.*)\)$", where, re.IGNORECASE)
+        if equals:
+            field, value = equals.groups()
+            return lambda feature: str(feature.get(field)) == value
+        if contains:
+            field, values = contains.groups()
+            values = set(value.strip().strip("'").replace("''", "'") for value in values.split(","))
+            return lambda feature: str(feature.get(field)) in values
+        return lambda feature: True
+
+    def query(self, where="1=1", out_fields="*", return_geometry=True, out_sr=None, result_offset=0,
+              result_record_count=None, **kwargs):
+        with self.timed("Query"):
+            match = self._matches(where)
+            fields = None if out_fields in ("*", None) else out_fields.split(",")
+            features = []
+            for feature in self._features.values():
+                if not match(feature):
+                    continue
+                attributes = dict((key, value) for key, value in feature.items()
+                                  if key != "geometry" and (fields is None or key in fields))
+                geometry = dict(feature["geometry"]) if return_geometry and feature.get("geometry") else None
+                features.append(FakeFeature(attributes, geometry))
+            end = result_offset + result_record_count if result_record_count else None
+            return FakeFeatureSet(features[result_offset:end])
+
+    def edit_features(self, adds=None, updates=None, deletes=None, **kwargs):
+        with self.timed("ApplyEdits"):
+            results = []
+            for update in updates or []:
+                attributes = update["attributes"] if isinstance(update, dict) else update.attributes
+                oid = attributes["objectid"]
+                if oid in self._features:
+                    self._features[oid].update(attributes)
+                    results.append({"objectId": oid, "success": True})
+                else:
+                    results.append({"objectId": oid, "success": False,
+                                    "error": {"code": 1019, "description": "Object is missing"}})
+            return {"addResults": [], "updateResults": results, "deleteResults": []}
+
+
+class _Timer(object):
+    def __init__(self, stats, name, latency, lock):
+        self._stats = stats
+        self._name = name
+        self._latency = latency
+        self._lock = lock
+
+    def __enter__(self):
+        self._start = time.time()
+        if self._latency:
+            time.sleep(self._latency)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._lock:
+            stat = self._stats.setdefault(self._name, {"count": 0, "errors": 0, "throttled": 0, "latencies": []})
+            stat["count"] += 1
+            stat["latencies"].append(time.time() - self._start)
+            if exc_type:
+                stat["errors"] += 1
+
+
+class _FakeConnection(object):
+    token = None
+
+    def __init__(self):
+        self._session = requests.Session()
+
+
+class FakeGIS(object):
+    def __init__(self, *args, **kwargs):
+        self._con = _FakeConnection()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def build_layers(base_url, reports, comments, attachments, attachment_size, latency, stats, problems):
+    """Create a fake report layer and comment table with flagged records"""
+
+    layer_url = "{}/arcgis/rest/services/Reports/FeatureServer/0".format(base_url)
+    table_url = "{}/arcgis/rest/services/Reports/FeatureServer/1".format(base_url)
+
+    features = []
+    for oid in range(1, reports + 1):
+        features.append({"objectid": oid,
+                         "globalid": "{{{:08d}-0000-0000-0000-000000000000}}".format(oid),
+                         "probtype": random.choice(problems),
+                         "description": "Report {}".format(oid),
+                         "flag": "Yes",
+                         "requestid": None,
+                         "opendate": None,
+                         "created": int((time.time() - random.uniform(0, 3600)) * 1000),
+                         "geometry": {"x": random.uniform(-1e6, 1e6), "y": random.uniform(-1e6, 1e6)}})
+
+    rows = []
+    for oid in range(1, comments + 1):
+        rows.append({"objectid": oid,
+                     "parentglobalid": random.choice(features)["globalid"] if features else None,
+                     "comment": "Comment {}".format(oid),
+                     "flag": "Yes",
+                     "requestid": None})
+
+    layer = FakeReportLayer(layer_url, "Reports", features,
+                            relationships=[{"relatedTableId": 1, "keyField": "globalid"}],
+                            attachment_count=attachments, attachment_size=attachment_size,
+                            latency=latency, stats=stats)
+    table = FakeReportLayer(table_url, "Comments", rows,
+                            relationships=[{"relatedTableId": 0, "keyField": "parentglobalid"}],
+                            attachment_count=0, latency=latency, stats=stats)
+    return layer, table
+
+
+def run(reports=500, comments=0, attachments=0, attachment_size=64 * 1024, latency=0.0, jitter=0.0,
+        error_rate=0.0, rate_limit=0, layer_latency=0.0, workers=4, batch_size=100, request_rate=None):
+    """Export a set of fake reports to a mock Cityworks site and return the
+    throughput, per-stage latency and request counts"""
+
+    workdir = mkdtemp()
+    layer_stats = {}
+    try:
+        with MockCityworks(latency=latency, jitter=jitter, error_rate=error_rate, rate_limit=rate_limit,
+                           attachment_size=attachment_size) as mock:
+            layer, table = build_layers(mock.url, reports, comments, attachments, attachment_size,
+                                        layer_latency, layer_stats, list(mock.problems))
+            layers = {layer.url: layer, table.url: table}
+
+            event = {"cityworks": {"url": mock.url,
+                                   "username": "benchmark",
+                                   "password": "benchmark",
+                                   "timezone": "UTC",
+                                   "isCWOL": False,
+                                   "cache file": path.join(workdir, "cityworks_cache.json"),
+                                   "journal": path.join(workdir, "cityworks_journal.db"),
+                                   "metrics": path.join(workdir, "cityworks_metrics.json")},
+                     "arcgis": {"url": "https://localhost/portal",
+                                "username": "benchmark",
+                                "password": "benchmark",
+                                "layers": [layer.url],
+                                "tables": [table.url] if comments else [],
+                                "attachment workers": workers},
+                     "fields": {"layers": [["Details", "description"]],
+                                "tables": [["Comments", "comment"]],
+                                "ids": ["RequestId", "requestid"],
+                                "type": ["ProblemSid", "probtype"],
+                                "opendate": ["DateTimeInit", "opendate"],
+                                "created": "created"},
+                     "flag": {"field": "flag", "on": "Yes", "off": "No", "batch size": batch_size}}
+            if request_rate:
+                event["request governor"] = {"rate": request_rate, "burst": request_rate}
+
+            connect_to_cityworks.GIS = FakeGIS
+            connect_to_cityworks.FeatureLayer = lambda url, gis=None: layers[url]
+            connect_to_cityworks.log_to_file = False
+
+            start = time.time()
+            connect_to_cityworks.main(event, "benchmark")
+            elapsed = time.time() - start
+
+            stats = mock.stats()
+            stats.update(layer_stats)
+            exported = len(mock.requests)
+            copied_comments = sum(len(values) for values in mock.comments.values())
+
+            with open(path.join(workdir, "cityworks_metrics.json")) as metricsreader:
+                pipeline = json.load(metricsreader)
+
+    finally:
+        rmtree(workdir, ignore_errors=True)
+
+    return {"records": reports + comments,
+            "exported": exported,
+            "comments": copied_comments,
+            "seconds": elapsed,
+            "records per second": (exported + copied_comments) / elapsed if elapsed else None,
+            "requests": sum(stat["count"] for stat in stats.values()),
+            "stages": dict((name, {"count": stat["count"],
+                                   "errors": stat["errors"],
+                                   "throttled": stat["throttled"],
+                                   "p50": percentile(stat["latencies"], 50),
+                                   "p95": percentile(stat["latencies"], 95)}) for name, stat in stats.items()),
+            "pipeline": pipeline}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the Cityworks export against a local mock site")
+    parser.add_argument("--reports", type=int, default=500)
+    parser.add_argument("--comments", type=int, default=0)
+    parser.add_argument("--attachments", type=int, default=0, help="attachments per report")
+    parser.add_argument("--attachment-size", type=int, default=64 * 1024, help="bytes per attachment")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each Cityworks response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random seconds added to latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Cityworks calls that fail")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Cityworks requests per second before 429")
+    parser.add_argument("--layer-latency", type=float, default=0.0, help="seconds added to each layer call")
+    parser.add_argument("--workers", type=int, default=4, help="attachment transfer workers")
+    parser.add_argument("--batch-size", type=int, default=100, help="flag write-back batch size")
+    parser.add_argument("--request-rate", type=float, help="requests per second the script sends to each host")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run(reports=args.reports, comments=args.comments, attachments=args.attachments,
+                  attachment_size=args.attachment_size, latency=args.latency, jitter=args.jitter,
+                  error_rate=args.error_rate, rate_limit=args.rate_limit, layer_latency=args.layer_latency,
+                  workers=args.workers, batch_size=args.batch_size, request_rate=args.request_rate)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=4)
+    print(json.dumps(results, indent=4))
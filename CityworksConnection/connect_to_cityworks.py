@@ -29,18 +29,194 @@ from arcgis.features import FeatureLayer  # , Table
 
 import requests
 import json
-from os import path, remove
+import sqlite3
+from os import path, replace
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from datetime import datetime
 from dateutil.tz import gettz
 from dateutil.parser import parse
+import sys
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from feature_records import query_records
+from leases import open_leases
+from request_governor import governor
 
 cw_token = ""
 baseUrl = ""
 log_to_file = True
+chunk_size = 65536  # bytes of an attachment held in memory while it is transferred
+auth_errors = [2, 3]  # Cityworks response statuses for unauthorized requests and invalid credentials
+metrics = None
+
+# Upper bounds of the histogram buckets, in seconds
+stage_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+lag_buckets = [60, 300, 900, 1800, 3600, 7200, 14400, 43200, 86400, 172800, 604800]
+
+
+class ExportJournal(object):
+    """Write-ahead journal of records exported to Cityworks.
+
+    A record is journaled as soon as Cityworks accepts it, and is removed once
+    both its attachments have been copied and its flag has been written back
+    to the layer. A run that finds a record in the journal resumes only the
+    stages that are left instead of submitting the record again.
+
+    A journal shared by several workers on a file share is opened without
+    WAL, which SQLite does not support over a network file system."""
+
+    def __init__(self, db_path, shared=False):
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode={}".format("DELETE" if shared else "WAL"))
+        self._db.execute("""CREATE TABLE IF NOT EXISTS records (
+                            layer TEXT, oid INTEGER, request_id, open_date,
+                            attachments INTEGER DEFAULT 0, written_back INTEGER DEFAULT 0,
+                            PRIMARY KEY (layer, oid))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS attachments (
+                            layer TEXT, oid INTEGER, attachment_id INTEGER,
+                            PRIMARY KEY (layer, oid, attachment_id))""")
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            self._db.commit()
+        return rows
+
+    def _purge(self, layer):
+        self._execute("""DELETE FROM attachments WHERE layer = ? AND oid IN
+                         (SELECT oid FROM records WHERE layer = ? AND attachments = 1 AND written_back = 1)""",
+                      (layer, layer))
+        self._execute("DELETE FROM records WHERE layer = ? AND attachments = 1 AND written_back = 1", (layer,))
+
+    def get(self, layer, oid):
+        """Return the journaled request id and open date of a record, or None"""
+        rows = self._execute("SELECT request_id, open_date FROM records WHERE layer = ? AND oid = ?", (layer, oid))
+        return rows[0] if rows else None
+
+    def submitted(self, layer, oid, request_id, open_date=""):
+        self._execute("INSERT OR REPLACE INTO records (layer, oid, request_id, open_date) VALUES (?, ?, ?, ?)",
+                      (layer, oid, request_id, open_date))
+
+    def copied_attachments(self, layer, oid):
+        rows = self._execute("SELECT attachment_id FROM attachments WHERE layer = ? AND oid = ?", (layer, oid))
+        return set(row[0] for row in rows)
+
+    def attachment_copied(self, layer, oid, attachment_id):
+        self._execute("INSERT OR IGNORE INTO attachments VALUES (?, ?, ?)", (layer, oid, attachment_id))
+
+    def attachments_done(self, layer, oid):
+        self._execute("UPDATE records SET attachments = 1 WHERE layer = ? AND oid = ?", (layer, oid))
+        self._purge(layer)
+
+    def written_back(self, layer, oids):
+        for oid in oids:
+            self._execute("UPDATE records SET written_back = 1 WHERE layer = ? AND oid = ?", (layer, oid))
+        self._purge(layer)
+
+    def pending_attachments(self, layer):
+        """Return (oid, request id) of written back records whose attachments
+        were not copied"""
+        return self._execute("""SELECT oid, request_id FROM records
+                                WHERE layer = ? AND written_back = 1 AND attachments = 0""", (layer,))
+
+
+class Histogram(object):
+    """Counts of observed values per bucket. The last count holds the values
+    larger than the last bucket"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        return {"buckets": self.buckets + ["+Inf"],
+                "counts": self.counts,
+                "count": self.count,
+                "sum": self.total,
+                "max": self.max}
+
+
+class ExportMetrics(object):
+    """Per-stage timings of the export and the lag between the creation of a
+    report and its Cityworks request"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.start = time()
+        self.stages = {}
+        self.lag = Histogram(lag_buckets)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram(stage_buckets)
+            self.stages[stage].observe(seconds)
+
+    def timer(self, stage):
+        return _StageTimer(self, stage)
+
+    def request_created(self, created):
+        """Record the lag for a report created at the given epoch milliseconds"""
+        if created:
+            with self._lock:
+                self.lag.observe(max(0.0, time() - created / 1000.0))
+
+    def write(self, metrics_file):
+        """Save the metrics of this run as JSON"""
+        with self._lock:
+            output = {"start": datetime.fromtimestamp(self.start).isoformat(),
+                      "seconds": time() - self.start,
+                      "stages": dict((name, hist.as_dict()) for name, hist in self.stages.items()),
+                      "report to request lag": self.lag.as_dict()}
+        with open(metrics_file + ".tmp", "w") as metricswriter:
+            json.dump(output, metricswriter, indent=4)
+        replace(metrics_file + ".tmp", metrics_file)
+
+
+class _StageTimer(object):
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.observe(self._stage, time() - self._start)
 
 
 def get_response(url, params):
-    response = requests.post(url, params=params)
+    response = governor.request("post", url, params=params)
     try:
         return json.loads(response.text)
     except:
@@ -79,6 +255,68 @@ def get_cw_token(user, pwd, isCWOL):
         return "success"
 
 
+def fetch_token(user, pwd, isCWOL):
+    """Authenticate with Cityworks and return the new token, or the error"""
+    status = get_cw_token(user, pwd, isCWOL)
+    if status != "success":
+        return status
+    return cw_token
+
+
+def read_cache(cache_file, key, ttl):
+    """Return the session values cached for this Cityworks site and user that
+    are younger than ttl seconds"""
+
+    try:
+        with open(cache_file) as cachereader:
+            entries = json.load(cachereader)[key]
+    except (IOError, ValueError, KeyError, TypeError):
+        return {}
+
+    now = time()
+    cache = {}
+    for name, entry in entries.items():
+        try:
+            if now - entry["time"] < ttl and entry["value"]:
+                cache[name] = entry
+        except (KeyError, TypeError):
+            continue  # malformed entry, fetch it again
+    return cache
+
+
+def write_cache(cache_file, key, cache):
+    """Save the session values for this Cityworks site and user"""
+
+    try:
+        with open(cache_file) as cachereader:
+            entries = json.load(cachereader)
+        if not isinstance(entries, dict):
+            entries = {}
+    except (IOError, ValueError):
+        entries = {}
+    entries[key] = cache
+
+    # write to a temporary file first so that a crash never leaves a partial cache
+    try:
+        with open(cache_file + ".tmp", "w") as cachewriter:
+            json.dump(entries, cachewriter)
+        replace(cache_file + ".tmp", cache_file)
+    except (IOError, OSError):
+        pass  # the cache is an optimization only
+
+
+def get_cached(cache, name, fetch):
+    """Return a session value from the cache, fetching and caching it when it
+    is missing. Returns the error message when the fetch fails"""
+
+    if name not in cache:
+        value = fetch()
+        if isinstance(value, str) and value.startswith("error"):
+            return value
+        cache[name] = {"value": value, "time": time()}
+    return cache[name]["value"]
+
+
 def get_wkid():
     """Retrieve the WKID of the cityworks layers"""
 
@@ -90,7 +328,7 @@ def get_wkid():
     try:
         return response["Value"]["SpatialReference"]
 
-    except KeyError:
+    except (KeyError, TypeError):
         return "error"
 
 
@@ -158,6 +396,9 @@ def submit_to_cw(row, prob_types, fields, oid, typefields):
     url = "{}/Services/AMS/ServiceRequest/Create".format(baseUrl)
     
     response = get_response(url, params)
+    if response.get("Status") in auth_errors:
+        return 'error: unauthorized: {}'.format(response.get('Message', ''))
+
     try:
         return response["Value"]
 
@@ -170,32 +411,167 @@ def submit_to_cw(row, prob_types, fields, oid, typefields):
             return 'error: {}'.format(response)        
 
 
-def copy_attachment(attachmentmgr, attachment, oid, requestid):
+class AttachmentUpload(object):
+    """A multipart/form-data request body that streams an attachment to
+    Cityworks from an iterator of chunks of its content. Only one chunk of the
+    attachment is held in memory at a time."""
+
+    def __init__(self, source, fields, filename, content_type, size=None):
+        boundary = uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(boundary)
+
+        head = ""
+        for name, value in fields.items():
+            head += "--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n{}\r\n".format(boundary, name, value)
+        head += "--{}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{}\"\r\n".format(boundary, filename)
+        head += "Content-Type: {}\r\n\r\n".format(content_type)
+        self._head = head.encode("utf-8")
+        self._tail = "\r\n--{}--\r\n".format(boundary).encode("utf-8")
+
+        # requests sends a Content-Length when len is set, otherwise the body is chunked
+        self.len = len(self._head) + size + len(self._tail) if size is not None else 0
+
+        self._source = source
+        self._parts = self._iter_parts()
+        self._buffer = b""
+
+    def _iter_parts(self):
+        yield self._head
+        for chunk in self._source:
+            if chunk:
+                yield chunk
+        yield self._tail
+
+    def __iter__(self):
+        if self._buffer:
+            data, self._buffer = self._buffer, b""
+            yield data
+        for part in self._parts:
+            yield part
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._parts)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def get_session(gis):
+    """Return the requests session of the GIS connection, which carries its
+    authentication, or None for versions of the ArcGIS API without one"""
+    session = getattr(gis._con, "_session", None)
+    return session if isinstance(session, requests.Session) else None
+
+
+def upload_attachment(body):
+    url = "{}/Services/AMS/Attachments/AddRequestAttachment".format(baseUrl)
+    # the body streams from the download, so a throttled upload is not sent again
+    return governor.request("post", url, retry=False, data=body, headers={"Content-Type": body.content_type})
+
 
-    # download attachment
-    attpath = attachmentmgr.download(oid, attachment["id"])
+def copy_attachment(lyr, attachment, oid, requestid, gis):
+    """Stream an attachment from an ArcGIS feature to a Cityworks request"""
 
-    # upload attachment
-    file = open(attpath[0], "rb")
     data = {"RequestId": requestid}
     json_data = json.dumps(data, separators=(",", ":"))
-    params = {"token": cw_token, "data": json_data}
-    files = {"file": (path.basename(attpath[0]), file)}
-    url = "{}/Services/AMS/Attachments/AddRequestAttachment".format(baseUrl)
-    response = requests.post(url, files=files, data=params)
+    fields = {"token": cw_token, "data": json_data}
+    content_type = attachment.get("contentType") or "application/octet-stream"
+
+    session = get_session(gis)
+    if session is None:
+        # download attachment through the attachment manager, then stream the file
+        folder = mkdtemp()
+        try:
+            attpath = lyr.attachments.download(oid, attachment["id"], folder)
+            with open(attpath[0], "rb") as file:
+                body = AttachmentUpload(iter(lambda: file.read(chunk_size), b""), fields, attachment["name"],
+                                        content_type, path.getsize(attpath[0]))
+                response = upload_attachment(body)
+        finally:
+            rmtree(folder, ignore_errors=True)
+        return json.loads(response.text)
 
-    # delete downloaded file
-    file.close()
-    remove(attpath[0])
+    # download attachment through the GIS session, so that token, IWA and PKI sign-ins all apply.
+    # Sessions of older API versions do not add the token themselves.
+    url = "{}/{}/attachments/{}".format(lyr.url, oid, attachment["id"])
+    token = getattr(gis._con, "token", None)
+    params = {"token": token} if token and session.auth is None else {}
+    with governor.request("get", url, session=session, params=params, stream=True) as source:
+        source.raise_for_status()
+
+        # upload attachment
+        body = AttachmentUpload(source.iter_content(chunk_size), fields, attachment["name"], content_type,
+                                attachment.get("size"))
+        response = upload_attachment(body)
 
     return json.loads(response.text)
 
 
+def copy_attachments(lyr, oid, requestid, gis, journal):
+    """Copy all attachments of a feature to a Cityworks request, skipping
+    attachments the journal records as already copied.
+    Returns a list of error messages"""
+
+    with metrics.timer("attachments"):
+        return _copy_attachments(lyr, oid, requestid, gis, journal)
+
+
+def _copy_attachments(lyr, oid, requestid, gis, journal):
+    errors = []
+    try:
+        attachments = governor.call(lyr.url, lyr.attachments.get_list, oid)
+    except RuntimeError:
+        journal.attachments_done(lyr.url, oid)
+        return errors  # layer doesn't support attachments
+
+    copied = journal.copied_attachments(lyr.url, oid)
+    for attachment in attachments:
+        if attachment["id"] in copied:
+            continue
+        try:
+            response = copy_attachment(lyr, attachment, oid, requestid, gis)
+        except Exception as e:
+            errors.append(str(e))
+            continue
+
+        if response["Status"] is not 0:
+            try:
+                errors.append(response["ErrorMessages"])
+            except KeyError:
+                errors.append(response["Message"])
+        else:
+            journal.attachment_copied(lyr.url, oid, attachment["id"])
+            copied.add(attachment["id"])
+
+    # attachments that failed are copied again on the next run
+    if all(attachment["id"] in copied for attachment in attachments):
+        journal.attachments_done(lyr.url, oid)
+    return errors
+
+
+def log_attachment_errors(transfers, name, log):
+    """Wait for queued attachment transfers and log any errors"""
+
+    for oid, transfer in transfers:
+        try:
+            errors = transfer.result()
+        except Exception as e:
+            errors = [str(e)]
+        for error in errors:
+            write_log(log, "Error copying attachment from record {} in {}: {}".format(oid, name, error))
+
+
 def copy_comments(record, parent, fields, ids):
 
-    values = {ids[0]: parent.attributes[ids[1]]}
+    values = {ids[0]: parent.get_value(ids[1])}
     for field in fields:
-        values[field[0]] = record.attributes[field[1]]
+        values[field[0]] = record.get_value(field[1])
 
     json_data = json.dumps(values, separators=(",", ":"))
     params = {"data": json_data, "token": cw_token}
@@ -208,23 +584,70 @@ def copy_comments(record, parent, fields, ids):
         return 'error'
 
 
-def get_parent(lyr, pkey_fld, record, fkey_fld):
+def write_log(log, msg):
+    """Write a message to the log file, or print it when not logging to file"""
+    if log_to_file:
+        log.write(msg + "\n")
+    else:
+        print(msg)
+
+
+def write_updates(lyr, updates, log):
+    """Apply a batch of attribute-only updates to a layer and log the status
+    of each edit. Returns the ObjectIDs that were updated"""
+
+    if not updates:
+        return []
+
+    name = lyr.properties["name"]
+    oid_fld = lyr.properties.objectIdField
+    try:
+        with metrics.timer("write-back"):
+            status = governor.apply_edits(lyr, updates=updates)
+    except Exception as e:
+        oids = [update["attributes"][oid_fld] for update in updates]
+        write_log(log, "Failed to apply updates to {}, ObjectIDs:{} {}".format(name, oids, e))
+        return []
+
+    updated = []
+    for result in status.get("updateResults", []):
+        write_log(log, "Status of updates to {}, ObjectID:{} {}".format(name, result.get("objectId"), result))
+        if result.get("success"):
+            updated.append(result.get("objectId"))
+    return updated
+
+
+def get_parents(lyr, pkey_fld, records, fkey_fld, fields, chunk=250):
+    """Retrieve the parent features of a set of related records.
+    Returns a dict of parent records keyed on the relationship key"""
+
+    keys = sorted(set(str(record.get_value(fkey_fld)) for record in records
+                      if record.get_value(fkey_fld) is not None))
+    out_fields = ",".join(set([pkey_fld] + fields))
 
-    sql = "{} = '{}'".format(pkey_fld, record.attributes[fkey_fld])
-    parents = lyr.query(where=sql)
-    return parents.features[0]
+    parents = {}
+    schema = None
+    for i in range(0, len(keys), chunk):
+        values = ",".join("'{}'".format(key.replace("'", "''")) for key in keys[i:i + chunk])
+        sql = "{} IN ({})".format(pkey_fld, values)
+        records, schema = query_records(lyr, schema, where=sql, out_fields=out_fields, return_geometry=False)
+        for parent in records:
+            parents[str(parent.get_value(pkey_fld))] = parent
+    return parents
 
 
 def main(event, context):
     import sys
     
     # Cityworks settings
-    global baseUrl
+    global baseUrl, cw_token, metrics
     baseUrl = event["cityworks"]["url"]
     cwUser = event["cityworks"]["username"]
     cwPwd = event["cityworks"]["password"]
     timezone = event["cityworks"].get("timezone", "")
     isCWOL = event["cityworks"].get("isCWOL", False)
+    cache_ttl = event["cityworks"].get("cache ttl", 3600)
+    cache_key = "{}|{}".format(baseUrl, cwUser)
 
     # ArcGIS Online/Portal settings
     orgUrl = event["arcgis"]["url"]
@@ -239,6 +662,9 @@ def main(event, context):
     ids = event["fields"]["ids"]
     probtypes = event["fields"]["type"]
     opendate = event["fields"].get("opendate", "")
+    created = event["fields"].get("created", "")
+    batch_size = event["flag"].get("batch size", 100)
+    attachment_workers = event["arcgis"].get("attachment workers", 4)
 
     if log_to_file:
         from datetime import datetime as dt
@@ -247,14 +673,45 @@ def main(event, context):
         log.write("\n{} ".format(dt.now()))
         log.write("Sending reports to: {}\n".format(baseUrl))
     else:
+        log = None
         print("Sending reports to: {}".format(baseUrl))
 
+    # Pace requests to each server, and back off when a server throttles
+    governor.configure(event.get("request governor"))
+
+    cache_file = event["cityworks"].get("cache file", path.join(sys.path[0], "cityworks_cache.json"))
+
+    # Workers sharing the layers also share the journal, so that a worker taking
+    # over a layer resumes the records exported by the worker that held it
+    lease_settings = event.get("leases")
+    shared_journal = bool(lease_settings and lease_settings.get("store"))
+    journal_file = event["cityworks"].get("journal", lease_settings["store"] if shared_journal
+                                          else path.join(sys.path[0], "cityworks_journal.db"))
+    metrics_file = event["cityworks"].get("metrics", path.join(sys.path[0], "cityworks_metrics.json"))
+    metrics = ExportMetrics()
+
+    executor = None
+    journal = None
+    leases = None
     try:
         # Connect to org/portal
         gis = GIS(orgUrl, username, password)
 
+        # attachments for different records are transferred concurrently
+        executor = ThreadPoolExecutor(max_workers=attachment_workers)
+
+        # records exported to Cityworks but not yet fully processed
+        journal = ExportJournal(journal_file, shared_journal)
+
+        # Session values are cached between runs
+        cache = read_cache(cache_file, cache_key, cache_ttl)
+        fetches = {"token": lambda: fetch_token(cwUser, cwPwd, isCWOL),
+                   "wkid": get_wkid,
+                   "problems": get_problem_types}
+
         # Get token for CW
-        status = get_cw_token(cwUser, cwPwd, isCWOL)
+        token_cached = "token" in cache
+        status = get_cached(cache, "token", fetches["token"])
 
         if "error" in status:
             if log_to_file:
@@ -262,9 +719,24 @@ def main(event, context):
             else:
                 print("Failed to get Cityworks token. {}".format(status))
             raise Exception("Failed to get Cityworks token.  {}".format(status))
-
-        # get wkid
-        sr = get_wkid()
+        cw_token = status
+
+        # get wkid and problem types. A cached token can be revoked on the server
+        # before it expires in the cache, so when a fetch fails with a cached
+        # token, get a new token and try once more.
+        setup = {}
+        for name in ["wkid", "problems"]:
+            value = get_cached(cache, name, fetches[name])
+            if isinstance(value, str) and token_cached:
+                token_cached = False
+                del cache["token"]
+                status = get_cached(cache, "token", fetches["token"])
+                if "error" not in status:
+                    cw_token = status
+                    value = get_cached(cache, name, fetches[name])
+            setup[name] = value
+
+        sr = setup["wkid"]
 
         if sr == "error":
             if log_to_file:
@@ -273,16 +745,27 @@ def main(event, context):
                 print("Spatial reference not defined")
             raise Exception("Spatial reference not defined")
 
-        # get problem types
-        prob_types = get_problem_types()
+        prob_types = setup["problems"]
 
-        if prob_types == "error":
+        if isinstance(prob_types, str):
             if log_to_file:
                 log.write("Problem types not defined\n")
             else:
                 print("Problem types not defined")
             raise Exception("Problem types not defined")
 
+        write_cache(cache_file, cache_key, cache)
+
+        # cached values that turn out to be stale are refreshed once per run
+        refreshed = []
+
+        # When several workers share this configuration, each exports only
+        # the layers it holds a lease on
+        leases = open_leases(lease_settings)
+        if leases:
+            leases.start()
+            layers = leases.acquire(layers, lambda layer: layer)
+
         for layer in layers:
             lyr = FeatureLayer(layer, gis=gis)
             oid_fld = lyr.properties.objectIdField
@@ -303,83 +786,122 @@ def main(event, context):
             except AttributeError:
                 pass
 
-            # query reports
-            sql = "{}='{}'".format(fc_flag, flag_values[0])
-            rows = lyr.query(where=sql, out_sr=sr)
-            updated_rows = []
+            # creation date of each report, for the report to request lag
+            created_fld = created
+            if not created_fld:
+                try:
+                    created_fld = lyr.properties.editFieldsInfo["creationDateField"]
+                except (AttributeError, KeyError, TypeError):
+                    created_fld = ""
 
-            for row in rows.features:
+            # query reports, keeping only the fields sent to Cityworks
+            sql = "{}='{}'".format(fc_flag, flag_values[0])
+            out_fields = [oid_fld, probtypes[1]] + [field[1] for field in layerfields]
+            if created_fld:
+                out_fields.append(created_fld)
+            with metrics.timer("query"):
+                rows, schema = query_records(lyr, where=sql, out_fields=",".join(set(out_fields)), out_sr=sr)
+
+            # Flag updates are written back in batches. Each batch is a
+            # checkpoint: a crash can only resubmit the reports exported since
+            # the last batch was written.
+            pending = []
+            transfers = []
+
+            # resume attachment copies interrupted after an earlier write-back
+            for oid, reqid in journal.pending_attachments(lyr.url):
+                transfers.append((oid, executor.submit(copy_attachments, lyr, oid, reqid, gis, journal)))
+
+            for row in rows:
                 try:
-                    oid = row.attributes[oid_fld]
+                    oid = row.get_value(oid_fld)
     
-                    # Submit feature to the Cityworks database
-                    request = submit_to_cw(row, prob_types, layerfields, oid, probtypes)
-                    
-                    try:
-                        reqid = request["RequestId"]
-                        initDate = int(parse(request[opendate[0]]).replace(tzinfo=gettz(timezone)).timestamp() * 1000) if opendate else ""                    
-                        
-                    except TypeError:
-                        if "WARNING" in request:
-                            msg = "Warning generated while copying ObjectID:{} from layer {} to Cityworks: {}".format(oid, lyrname, request)
-                            if log_to_file:
-                                log.write(msg+'\n')
+                    entry = journal.get(lyr.url, oid)
+                    if entry:
+                        # submitted by an earlier run that stopped before the write-back
+                        reqid, initDate = entry
+                    else:
+                        # Submit feature to the Cityworks database
+                        with metrics.timer("submit"):
+                            request = submit_to_cw(row, prob_types, layerfields, oid, probtypes)
+
+                        # An expired token or a problem type added since the catalog was
+                        # cached invalidates the cache. Refresh it and submit again.
+                        stale = ""
+                        if isinstance(request, str):
+                            if request.startswith("error: unauthorized"):
+                                stale = "token"
+                            elif "not found in Cityworks" in request:
+                                stale = "problems"
+                        if stale and stale not in refreshed:
+                            refreshed.append(stale)
+                            del cache[stale]
+                            value = get_cached(cache, stale, fetches[stale])
+                            if isinstance(value, str) and value.startswith("error"):
+                                write_log(log, "Failed to refresh Cityworks {}. {}".format(stale, value))
                             else:
-                                print(msg)
-                            continue
-                        elif 'error' in request:
-                            msg = "Error generated while copying ObjectID:{} from layer {} to Cityworks: {}".format(oid, lyrname, request)
-                            if log_to_file:
-                                log.write(msg+'\n')
+                                if stale == "token":
+                                    cw_token = value
+                                else:
+                                    prob_types = value
+                                write_cache(cache_file, cache_key, cache)
+                                with metrics.timer("submit"):
+                                    request = submit_to_cw(row, prob_types, layerfields, oid, probtypes)
+                    
+                        try:
+                            reqid = request["RequestId"]
+
+                        except TypeError:
+                            if "WARNING" in request:
+                                msg = "Warning generated while copying ObjectID:{} from layer {} to Cityworks: {}".format(oid, lyrname, request)
+                                if log_to_file:
+                                    log.write(msg+'\n')
+                                else:
+                                    print(msg)
+                                continue
+                            elif 'error' in request:
+                                msg = "Error generated while copying ObjectID:{} from layer {} to Cityworks: {}".format(oid, lyrname, request)
+                                if log_to_file:
+                                    log.write(msg+'\n')
+                                else:
+                                    print(msg)
+                                continue
                             else:
-                                print(msg)
-                            continue
-                        else:
-                            msg = "Uncaught response generated while copying ObjectID:{} from layer {} to Cityworks: {}".format(oid, lyrname, request)
+                                msg = "Uncaught response generated while copying ObjectID:{} from layer {} to Cityworks: {}".format(oid, lyrname, request)
+                                if log_to_file:
+                                    log.write(msg+'\n')
+                                else:
+                                    print(msg)
+                                continue                   
+
+                        # journal the request before anything else can fail, so it is never submitted twice
+                        journal.submitted(lyr.url, oid, reqid)
+                        try:
+                            initDate = int(parse(request[opendate[0]]).replace(tzinfo=gettz(timezone)).timestamp() * 1000) if opendate else ""
+                        except (KeyError, TypeError, ValueError, OverflowError):
+                            initDate = ""
+                            msg = "Open date of request {} for ObjectID:{} in layer {} could not be read: {}".format(reqid, oid, lyrname, request.get(opendate[0]))
                             if log_to_file:
                                 log.write(msg+'\n')
                             else:
                                 print(msg)
-                            continue                   
-    
-                    # update the record in the service so that it evaluates falsely against sql
-                    sql = "{}='{}'".format(oid_fld, oid)
-                    row_orig = lyr.query(where=sql).features[0]
-                    row_orig.attributes[fc_flag] = flag_values[1]
-                    if opendate:
-                        row_orig.attributes[opendate[1]] = initDate
-                    try:
-                        row_orig.attributes[ids[1]] = reqid
-                    except TypeError:
-                        row_orig.attributes[ids[1]] = str(reqid)
-    
-                    # apply edits to updated row
-                    status = lyr.edit_features(updates=[row_orig])
-                    if log_to_file:
-                        log.write("Status of updates to {}, ObjectID:{} {}\n".format(lyr.properties["name"], oid, status))
-                    else:
-                        print("Status of updates to {}, ObjectID:{} {}".format(lyr.properties["name"], oid, status))         
+                        if initDate:
+                            journal.submitted(lyr.url, oid, reqid, initDate)
+                        if created_fld:
+                            metrics.request_created(row.get_value(created_fld))
+
+                    # queue an update so that the record evaluates falsely against sql.
+                    # Only attributes are sent, so the geometry queried in the
+                    # Cityworks spatial reference is never written back.
+                    attributes = {oid_fld: oid,
+                                  fc_flag: flag_values[1],
+                                  ids[1]: reqid}
+                    if opendate and initDate:
+                        attributes[opendate[1]] = initDate
+                    pending.append({"attributes": attributes})
                     
-                    # attachments
-                    try:
-                        attachmentmgr = lyr.attachments
-                        attachments = attachmentmgr.get_list(oid)
-    
-                        for attachment in attachments:
-                            response = copy_attachment(attachmentmgr, attachment, oid, reqid)
-                            if response["Status"] is not 0:
-                                try:
-                                    error = response["ErrorMessages"]
-                                except KeyError:
-                                    error = response["Message"]
-    
-                                msg = "Error copying attachment from feature {} in layer {}: {}".format(oid, lyrname, error)
-                                if log_to_file:
-                                    log.write(msg+'\n')
-                                else:
-                                    print(msg)
-                    except RuntimeError:
-                        pass  # feature layer doesn't support attachments
+                    # attachments are copied in the background while the next record is exported
+                    transfers.append((oid, executor.submit(copy_attachments, lyr, oid, reqid, gis, journal)))
                 
                 # any other error in row execution, move on to next row
                 except Exception as e:
@@ -388,85 +910,89 @@ def main(event, context):
                     else:
                         print(str(e))
                     continue
+
+                if len(pending) >= batch_size:
+                    journal.written_back(lyr.url, write_updates(lyr, pending, log))
+                    pending = []
                 # end of row execution
+
+            journal.written_back(lyr.url, write_updates(lyr, pending, log))
+            log_attachment_errors(transfers, lyrname, log)
             # end of features execution
             
             # related records
             rel_records = []
+            rel_transfers = []
+            parents = {}
             #if comments tables aren't used, script will crash here
             try:
                 if len(lyr.properties.relationships) > 0:
                     # related records
                     rellyr = FeatureLayer(reltable, gis=gis)
                     relname = rellyr.properties["name"]
+                    rel_oid_fld = rellyr.properties.objectIdField
                     pkey_fld = lyr.properties.relationships[0]["keyField"]
                     fkey_fld = rellyr.properties.relationships[0]["keyField"]
                     sql = "{}='{}'".format(fc_flag, flag_values[0])
-                    rel_records = rellyr.query(where=sql)
+                    out_fields = [rel_oid_fld, fkey_fld] + [field[1] for field in tablefields]
+                    with metrics.timer("query"):
+                        rel_records, schema = query_records(rellyr, where=sql, out_fields=",".join(set(out_fields)),
+                                                            return_geometry=False)
+
+                    # look up the parent reports of all flagged comments at once
+                    with metrics.timer("parents"):
+                        parents = get_parents(lyr, pkey_fld, rel_records, fkey_fld, [ids[1]])
+
+                    for rel_oid, reqid in journal.pending_attachments(rellyr.url):
+                        rel_transfers.append((rel_oid, executor.submit(copy_attachments, rellyr, rel_oid,
+                                                                       reqid, gis, journal)))
             # if related tables aren't being used
             except AttributeError:
                 pass
             except KeyError:
                 relname = "Comments"
-            updated_rows = []
+            pending = []
             for record in rel_records:
                 try:
-                    rel_oid = record.attributes[oid_fld]
-                    parent = get_parent(lyr, pkey_fld, record, fkey_fld)
+                    rel_oid = record.get_value(rel_oid_fld)
+                    parent = parents.get(str(record.get_value(fkey_fld)))
+                    if parent is None:
+                        write_log(log, "Parent report not found for record {} in {}".format(rel_oid, relname))
+                        continue
     
-                    # Process comments
-                    response = copy_comments(record, parent, tablefields, ids)
+                    if not journal.get(rellyr.url, rel_oid):
+                        # Process comments
+                        with metrics.timer("comments"):
+                            response = copy_comments(record, parent, tablefields, ids)
     
-                    if 'error' in response:
-                        if log_to_file:
-                            log.write('Error accessing comment table {}\n'.format(relname))
-                        else:
-                            print('Error accessing comment table {}'.format(relname))
-                        break
+                        if 'error' in response:
+                            if log_to_file:
+                                log.write('Error accessing comment table {}\n'.format(relname))
+                            else:
+                                print('Error accessing comment table {}'.format(relname))
+                            break
     
-                    elif response["Status"] is not 0:
-                        try:
-                            error = response["ErrorMessages"]
-                        except KeyError:
-                            error = response["Message"]
-                        msg = "Error copying record {} from {}: {}".format(rel_oid, relname, error)
-                        if log_to_file:
-                            log.write(msg+'\n')
-                        else:
-                            print(msg)
-                        continue
-                    else:
-                        record.attributes[fc_flag] = flag_values[1]
-                        try:
-                            record.attributes[ids[1]] = parent.attributes[ids[1]]
-                        except TypeError:
-                            record.attributes[ids[1]] = str(parent.attributes[ids[1]])
-                        
-                        # apply edits to updated record
-                        status = rellyr.edit_features(updates=[record])
-                        if log_to_file:
-                            log.write("Status of updates to {}, ObjectID:{} comments: {}\n".format(relname, rel_oid, status))
-                        else:
-                            print("Status of updates to {}, ObjectID:{} comments: {}".format(relname, rel_oid, status))                    
+                        elif response["Status"] is not 0:
+                            try:
+                                error = response["ErrorMessages"]
+                            except KeyError:
+                                error = response["Message"]
+                            msg = "Error copying record {} from {}: {}".format(rel_oid, relname, error)
+                            if log_to_file:
+                                log.write(msg+'\n')
+                            else:
+                                print(msg)
+                            continue
+                        journal.submitted(rellyr.url, rel_oid, parent.get_value(ids[1]))
+
+                    # queue the comment flag update
+                    pending.append({"attributes": {rel_oid_fld: rel_oid,
+                                                   fc_flag: flag_values[1],
+                                                   ids[1]: parent.get_value(ids[1])}})
                     
                     # Upload comment attachments
-                    try:
-                        attachmentmgr = rellyr.attachments
-                        attachments = attachmentmgr.get_list(rel_oid)
-                        for attachment in attachments:
-                            response = copy_attachment(attachmentmgr, attachment, rel_oid, parent.attributes[ids[1]])
-                            if response["Status"] is not 0:
-                                try:
-                                    error = response["ErrorMessages"]
-                                except KeyError:
-                                    error = response["Message"]
-                                msg = "Error copying attachment. Record {} in table {}: {}".format(rel_oid, relname, error)
-                                if log_to_file:
-                                    log.write(msg+'\n')
-                                else:
-                                    print(msg)
-                    except RuntimeError:
-                        pass  # table doesn't support attachments
+                    rel_transfers.append((rel_oid, executor.submit(copy_attachments, rellyr, rel_oid,
+                                                                   parent.get_value(ids[1]), gis, journal)))
                 
                 # any other uncaught Exception in related record export, move on to next row
                 except Exception as e:
@@ -475,6 +1001,15 @@ def main(event, context):
                     else:
                         print(str(e))
                     continue                    
+
+                if len(pending) >= batch_size:
+                    journal.written_back(rellyr.url, write_updates(rellyr, pending, log))
+                    pending = []
+
+            if pending:
+                journal.written_back(rellyr.url, write_updates(rellyr, pending, log))
+            if rel_transfers:
+                log_attachment_errors(rel_transfers, relname, log)
             
             print("Finished processing: {}".format(lyrname))
 
@@ -495,6 +1030,16 @@ def main(event, context):
             log.write('error: {}, Line {}'.format(exc_typ, exc_tb.tb_lineno))        
     
     finally:
+        if executor:
+            executor.shutdown()
+        if leases:
+            leases.stop()
+        if journal:
+            journal.close()
+        try:
+            metrics.write(metrics_file)
+        except (IOError, OSError) as e:
+            print("Failed to write metrics file {}. {}".format(metrics_file, e))
         if log_to_file:            
             log.close()
 
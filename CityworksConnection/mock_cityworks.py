@@ -0,0 +1,287 @@
+# ------------------------------------------------------------------------------
+# Name:        mock_cityworks.py
+# Purpose:     Local stand-in for the Cityworks services used by
+#              connect_to_cityworks.py, for load testing the export
+#
+# Copyright 2016 Esri
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# ------------------------------------------------------------------------------
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from threading import Lock, Thread
+from datetime import datetime
+from uuid import uuid4
+import itertools
+import random
+import json
+import time
+
+
+class MockCityworks(object):
+    """Serves the Cityworks endpoints the export calls, plus an ArcGIS style
+    attachment endpoint, with configurable latency, errors and throttling.
+
+    latency - seconds added to every response
+    jitter - maximum random seconds added on top of latency
+    error_rate - fraction of calls answered with a Cityworks error status
+    rate_limit - requests per second allowed before answering 429, 0 for none
+    problems - problem codes in the public problem catalog
+    attachment_size - bytes served for each ArcGIS attachment
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=0,
+                 problems=("POTHOLE", "GRAFFITI", "STREETLIGHT"), attachment_size=256 * 1024, wkid=3857):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.problems = dict((code, sid) for sid, code in enumerate(problems, 1))
+        self.attachment_size = attachment_size
+        self.wkid = wkid
+
+        self.tokens = set()
+        self.requests = {}
+        self.attachments = {}
+        self.comments = {}
+
+        self._lock = Lock()
+        self._request_ids = itertools.count(1)
+        self._window = []
+        self._stats = {}
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def stats(self):
+        """Return a copy of the per-endpoint call counts, statuses and latencies"""
+        with self._lock:
+            return dict((name, {"count": stat["count"],
+                                "errors": stat["errors"],
+                                "throttled": stat["throttled"],
+                                "latencies": list(stat["latencies"])}) for name, stat in self._stats.items())
+
+    def _record(self, name, seconds, outcome):
+        with self._lock:
+            stat = self._stats.setdefault(name, {"count": 0, "errors": 0, "throttled": 0, "latencies": []})
+            stat["count"] += 1
+            stat["latencies"].append(seconds)
+            if outcome in ("errors", "throttled"):
+                stat[outcome] += 1
+
+    def _throttled(self):
+        if not self.rate_limit:
+            return False
+        now = time.time()
+        with self._lock:
+            self._window = [t for t in self._window if now - t < 1]
+            if len(self._window) >= self.rate_limit:
+                return True
+            self._window.append(now)
+        return False
+
+    def _delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _fail(self):
+        return random.random() < self.error_rate
+
+    # Cityworks services
+
+    def authenticate(self, data, token):
+        token = uuid4().hex
+        with self._lock:
+            self.tokens.add(token)
+        return {"Status": 0, "Value": {"Token": token}}
+
+    def user_preferences(self, data, token):
+        return {"Status": 0, "Value": {"SpatialReference": self.wkid}}
+
+    def problems_catalog(self, data, token):
+        return {"Status": 0, "Value": [{"ProblemCode": code, "ProblemSid": sid}
+                                       for code, sid in self.problems.items()]}
+
+    def create_request(self, data, token):
+        if int(data.get("ProblemSid", 0)) not in self.problems.values():
+            return {"Status": 1, "Message": "Unknown problem", "Value": None}
+        with self._lock:
+            request_id = next(self._request_ids)
+            self.requests[request_id] = data
+        return {"Status": 0, "Value": {"RequestId": request_id,
+                                       "DateTimeInit": datetime.now().isoformat()}}
+
+    def add_comment(self, data, token):
+        with self._lock:
+            self.comments.setdefault(data.get("RequestId"), []).append(data)
+        return {"Status": 0, "Value": {"CallerType": "", "RequestId": data.get("RequestId")}}
+
+    def add_attachment(self, data, token, size):
+        with self._lock:
+            self.attachments.setdefault(data.get("RequestId"), []).append(size)
+        return {"Status": 0, "Value": {"RequestId": data.get("RequestId")}}
+
+
+_endpoints = {"/Services/General/Authentication/CityworksOnlineAuthenticate": "authenticate",
+              "/Services/General/Authentication/Authenticate": "authenticate",
+              "/Services/AMS/Preferences/User": "user_preferences",
+              "/Services/AMS/ServiceRequest/Problems": "problems_catalog",
+              "/Services/AMS/ServiceRequest/Create": "create_request",
+              "/Services/AMS/CustomerCall/AddToRequest": "add_comment",
+              "/Services/AMS/Attachments/AddRequestAttachment": "add_attachment"}
+
+_unauthenticated = ["authenticate"]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # ArcGIS attachment endpoint: .../FeatureServer/0/<oid>/attachments/<id>
+        mock = self.server.mock
+        start = time.time()
+        if "/attachments/" not in self.path:
+            self._send(404, {"error": {"code": 404, "message": "Not found"}})
+            return
+        if mock._throttled():
+            self._send(429, {"error": {"code": 429, "message": "Too many requests"}})
+            mock._record("DownloadAttachment", time.time() - start, "throttled")
+            return
+        mock._delay()
+        self._send(200, b"\0" * mock.attachment_size, "application/octet-stream")
+        mock._record("DownloadAttachment", time.time() - start, "ok")
+
+    def do_POST(self):
+        mock = self.server.mock
+        start = time.time()
+        url = urlparse(self.path)
+        name = _endpoints.get(url.path)
+        if not name:
+            self._send(404, {"Status": 1, "Message": "Not found"})
+            return
+
+        body = self._read_body()
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        content_type = self.headers.get("Content-Type", "")
+        size = 0
+        if content_type.startswith("multipart/form-data"):
+            params.update(_parse_multipart(body, content_type))
+            size = len(params.pop("file", b""))
+        elif body:
+            params.update((key, values[0]) for key, values in parse_qs(body.decode("utf-8")).items())
+
+        if mock._throttled():
+            self._send(429, {"Status": 1, "Message": "Too many requests"})
+            mock._record(name, time.time() - start, "throttled")
+            return
+        mock._delay()
+
+        data = json.loads(params.get("data", "{}"))
+        token = params.get("token", "")
+        if name not in _unauthenticated and token not in mock.tokens:
+            response = {"Status": 2, "Message": "Unauthorized", "Value": None}
+        elif mock._fail():
+            response = {"Status": 1, "Message": "Simulated failure", "ErrorMessages": ["Simulated failure"],
+                        "Value": None}
+        elif name == "add_attachment":
+            response = mock.add_attachment(data, token, size)
+        else:
+            response = getattr(mock, name)(data, token)
+
+        self._send(200, response)
+        mock._record(name, time.time() - start, "ok" if response["Status"] == 0 else "errors")
+
+
+def _parse_multipart(body, content_type):
+    """Return the form fields of a multipart body. The file part is returned
+    as bytes under 'file'"""
+
+    boundary = content_type.split("boundary=")[1].strip('"').encode("utf-8")
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        head, value = part.split(b"\r\n\r\n", 1)
+        value = value[:-2] if value.endswith(b"\r\n") else value
+        disposition = [line for line in head.decode("utf-8").split("\r\n") if "name=" in line]
+        if not disposition:
+            continue
+        name = disposition[0].split('name="')[1].split('"')[0]
+        fields[name] = value if name == "file" else value.decode("utf-8")
+    return fields
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the Cityworks services")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random seconds added to latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls that fail")
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per second before answering 429")
+    args = parser.parse_args()
+
+    server = MockCityworks(port=args.port, latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, rate_limit=args.rate_limit)
+    print("Mock Cityworks listening on {}".format(server.url))
+    server._server.serve_forever()
@@ -20,10 +20,15 @@
 
 from datetime import datetime as dt
 from os import path, sys
+from concurrent.futures import ThreadPoolExecutor
 from arcgis.gis import GIS
 from arcgis.features import FeatureLayer
 from arcgis.apps import workforce
 
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from feature_records import query_records
+from request_governor import governor, is_throttled, is_connection_failure
+
 orgURL = ''     # URL to ArcGIS Online organization or ArcGIS Portal
 username = ''   # Username of an account in the org/portal that can access and edit all services listed below
 password = ''   # Password corresponding to the username provided above
@@ -36,7 +41,19 @@ password = ''   # Password corresponding to the username provided above
 #                  'Name of Reporter field': 'Name of Workforce field',
 #                  'Another Reporter field to map':'to another workforce field'},
 #              'update field': 'Name of field in Reporter layer tracking which reports have  been copied to Workforce',
-#              'update value': 'Value in update field indicating that a report has already been copied.'
+#              'update value': 'Value in update field indicating that a report has already been copied.',
+#              'auto dispatch': {  # Optional. Assign each new report to the nearest available worker
+#                  'workers url': 'Workforce workers layer, or another layer with the current location of each worker',
+#                  'available query': 'SQL query identifying available workers. Default: status = 1 (working)',
+#                  'worker id field': 'Field of the workers layer referenced by the workerid field. Default: ObjectID',
+#                  'max assignments': 'Maximum number of open assignments per worker. Default: 10',
+#                  'max distance': 'Maximum distance to a worker, in units of the reports layer. Default: no limit',
+#                  'dispatcher id': 'Optional id of the dispatcher recorded on the assignments'},
+#              'deduplicate': {  # Optional. Create one assignment for reports of the same problem
+#                  'distance': 'Reports closer than this distance, in units of the reports layer, are duplicates',
+#                  'minutes': 'Reports created within this many minutes of each other are duplicates',
+#                  'report date field': 'Creation date field of the reports. Default: editor tracking field',
+#                  'assignment date field': 'Creation date field of the assignments. Default: editor tracking field'}
 #              },
 # {'source url': 'Another Reporter layer to monitor for new reports',
 #              'target url': '',
@@ -55,6 +72,219 @@ services = [{'source url': '',
              'update value': ''
              }]
 
+chunk_size = 100  # Number of assignments created, or reports updated, in each request
+max_workers = 4   # Number of requests sent to the target layer at the same time
+max_retries = 2   # Number of times a chunk of assignments is sent again when it is throttled or cannot be sent
+
+
+class KDTree(object):
+    """2-d tree of worker locations for nearest neighbour searches"""
+
+    def __init__(self, points):
+        # points: list of (x, y, key)
+        self._root = self._build(list(points), 0)
+
+    def _build(self, points, depth):
+        if not points:
+            return None
+        axis = depth % 2
+        points.sort(key=lambda point: point[axis])
+        median = len(points) // 2
+        return (points[median], axis,
+                self._build(points[:median], depth + 1),
+                self._build(points[median + 1:], depth + 1))
+
+    def nearest(self, x, y, accept=lambda key: True):
+        """Return (key, distance) of the nearest point whose key is accepted,
+        or (None, None) if no point is accepted"""
+
+        best = [None, float('inf')]
+        target = (x, y)
+
+        def search(node):
+            if node is None:
+                return
+            point, axis, left, right = node
+            dist = (point[0] - x) ** 2 + (point[1] - y) ** 2
+            if dist < best[1] and accept(point[2]):
+                best[0], best[1] = point[2], dist
+
+            diff = target[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            search(near)
+            if diff ** 2 < best[1]:
+                search(far)
+
+        search(self._root)
+        if best[0] is None:
+            return None, None
+        return best[0], best[1] ** 0.5
+
+
+def load_workers(settings, fl_target, gis, out_sr):
+    """Load the locations of available workers and the number of open
+    assignments of each worker. Returns a KDTree of worker locations and a
+    dict of workloads"""
+
+    fl_workers = FeatureLayer(settings['workers url'], gis)
+    id_field = settings.get('worker id field') or fl_workers.properties.objectIdField
+    workers = governor.call(fl_workers.url, fl_workers.query, where=settings.get('available query', 'status = 1'),
+                            out_fields=id_field, out_sr=out_sr)
+
+    points = [(worker.geometry['x'], worker.geometry['y'], worker.attributes[id_field])
+              for worker in workers.features if worker.geometry]
+
+    # assigned (1) and in progress (2) assignments count toward the workload
+    workloads = dict((point[2], 0) for point in points)
+    open_assignments = governor.call(fl_target.url, fl_target.query, where='status IN (1, 2)', out_fields='workerid',
+                                     return_geometry=False)
+    for assignment in open_assignments.features:
+        worker = assignment.attributes['workerid']
+        if worker in workloads:
+            workloads[worker] += 1
+
+    return KDTree(points), workloads
+
+
+def dispatch(adds, settings, workers, workloads):
+    """Assign each new assignment to the nearest worker with capacity.
+    Returns the number of assignments dispatched"""
+
+    capacity = int(settings.get('max assignments', 10))
+    max_distance = settings.get('max distance')
+    now = int(dt.now().timestamp() * 1000)
+
+    dispatched = 0
+    for add in adds:
+        worker, distance = workers.nearest(add['geometry']['x'], add['geometry']['y'],
+                                           lambda key: workloads[key] < capacity)
+        if worker is None:
+            break  # every available worker is at capacity
+        if max_distance and distance > float(max_distance):
+            continue
+
+        add['attributes']['workerid'] = worker
+        add['attributes']['status'] = 1  # assigned
+        add['attributes']['assigneddate'] = now
+        if settings.get('dispatcher id'):
+            add['attributes']['dispatcherid'] = settings['dispatcher id']
+        workloads[worker] += 1
+        dispatched += 1
+
+    return dispatched
+
+
+class DuplicateIndex(object):
+    """Grid of recent reports and assignments, hashed by location and time,
+    for finding reports of the same problem"""
+
+    def __init__(self, distance, window):
+        self.distance = float(distance)
+        self.window = float(window)
+        self._cells = {}
+
+    def _cell(self, x, y, t):
+        return int(x // self.distance), int(y // self.distance), int(t // self.window)
+
+    def add(self, x, y, t, item=None):
+        """Index a point. item identifies the report the point was added for,
+        None for an assignment already on the server"""
+        self._cells.setdefault(self._cell(x, y, t), []).append((x, y, t, item))
+
+    def find(self, x, y, t):
+        """Return the items of the indexed points within the distance and time window"""
+        cx, cy, ct = self._cell(x, y, t)
+        found = []
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                for k in (ct - 1, ct, ct + 1):
+                    for px, py, pt, item in self._cells.get((i, j, k), []):
+                        if abs(pt - t) <= self.window and (px - x) ** 2 + (py - y) ** 2 <= self.distance ** 2:
+                            found.append(item)
+        return found
+
+
+def _creation_field(layer, field):
+    if field:
+        return field
+    try:
+        return layer.properties.editFieldsInfo['creationDateField']
+    except (AttributeError, KeyError, TypeError):
+        return ''
+
+
+def load_recent_assignments(settings, fl_target, out_sr):
+    """Index the open assignments created within the deduplication window"""
+
+    window = float(settings['minutes']) * 60000
+    index = DuplicateIndex(settings['distance'], window)
+    date_field = _creation_field(fl_target, settings.get('assignment date field'))
+
+    # unassigned (0), assigned (1) and in progress (2) assignments
+    sql = 'status IN (0, 1, 2)'
+    if date_field:
+        since = dt.utcfromtimestamp(dt.now().timestamp() - window / 1000)
+        sql += " AND {} >= TIMESTAMP '{}'".format(date_field, since.strftime('%Y-%m-%d %H:%M:%S'))
+
+    now = dt.now().timestamp() * 1000
+    assignments = governor.call(fl_target.url, fl_target.query, where=sql, out_fields=date_field or '*', out_sr=out_sr)
+    for assignment in assignments.features:
+        if assignment.geometry:
+            created = assignment.attributes.get(date_field) if date_field else None
+            index.add(assignment.geometry['x'], assignment.geometry['y'], created or now)
+    return index
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _add_chunk(fl_target, chunk):
+    """Add a chunk of assignments. Invalid assignments are rejected one by one
+    instead of failing the chunk. The request is only sent again if the server
+    throttled it or it could not be sent, as other errors may follow adds the
+    server has already made. Returns the add results, or raises the last error"""
+    for attempt in range(max_retries + 1):
+        try:
+            return governor.call(fl_target.url, fl_target.edit_features, adds=chunk,
+                                 rollback_on_failure=False)['addResults']
+        except Exception as ex:
+            if attempt == max_retries or not (is_throttled(ex) or is_connection_failure(ex)):
+                raise
+
+
+def _try(func, *args):
+    try:
+        return func(*args), None
+    except Exception as ex:
+        return None, ex
+
+
+def add_assignments(fl_target, adds, log):
+    """Add assignments to the target layer in chunks on a small worker pool.
+    Returns the indexes of the assignments that were created"""
+
+    chunks = _chunks(adds, chunk_size)
+    created = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda chunk: _try(_add_chunk, fl_target, chunk), chunks)
+        for number, (chunk_results, error) in enumerate(results):
+            start = number * chunk_size
+            if error:
+                msg = 'Failed to add assignments {} to {}'.format(start, start + len(chunks[number]) - 1)
+                print('{}\n{}'.format(msg, error))
+                log.write('{}\n{}\n'.format(msg, error))
+                continue
+            for index, result in enumerate(chunk_results):
+                if result['success']:
+                    created.append(start + index)
+                else:
+                    msg = 'error {}: {}'.format(result['error']['code'], result['error']['description'])
+                    print(msg)
+                    log.write('{}\n'.format(msg))
+    return created
+
+
 def main():
     # Create log file
     with open(path.join(sys.path[0], 'attr_log.log'), 'a') as log:
@@ -75,48 +305,84 @@ def main():
                 # get field map
                 fields = [[key, service['fields'][key]] for key in service['fields'].keys()]
 
-                # Get source rows to copy
-                rows = fl_source.query(service['query'])
+                oid_field = fl_source.properties.objectIdField
+                out_fields = [oid_field] + [field[0] for field in fields]
+                if service.get('deduplicate'):
+                    report_date = _creation_field(fl_source, service['deduplicate'].get('report date field'))
+                    if report_date:
+                        out_fields.append(report_date)
+
+                # Get source rows to copy, keeping only the mapped fields
+                out_sr = fl_source.properties.extent.spatialReference
+                rows, schema = query_records(fl_source, where=service['query'], out_fields=','.join(set(out_fields)),
+                                             out_sr=out_sr)
+
                 adds = []
-                updates = []
+                sources = []  # ObjectID of the report each assignment is created from
+                duplicates = []  # ObjectIDs of reports of a problem that already has an assignment, with the matches
+
+                if service.get('deduplicate'):
+                    recent = load_recent_assignments(service['deduplicate'], fl_target, out_sr)
+                    now = dt.now().timestamp() * 1000
 
                 for row in rows:
+                    # collapse reports close in space and time into a single assignment
+                    if service.get('deduplicate'):
+                        x, y = row.geometry['x'], row.geometry['y']
+                        created = (row.get_value(report_date) if report_date else None) or now
+                        matches = recent.find(x, y, created)
+                        if matches:
+                            duplicates.append((row.get_value(oid_field), matches))
+                            continue
+                        recent.add(x, y, created, len(adds))
+
                     # Build dictionary of attributes & geometry in schema of target layer
                     # Default status and priority values can be overwritten if those fields are mapped to reporter layer
                     attributes = {'status': 0,
                                   'priority': 0}
 
                     for field in fields:
-                        attributes[field[1]] = row.attributes[field[0]]
+                        attributes[field[1]] = row.get_value(field[0])
 
                     new_request = {'attributes': attributes,
                                    'geometry': {'x': row.geometry['x'],
                                                 'y': row.geometry['y']}}
                     adds.append(new_request)
+                    sources.append(row.get_value(oid_field))
 
-                    # update row to indicate record has been copied
-                    if service['update field']:
-                        row.attributes[service['update field']] = service['update value']
-                        updates.append(row)
+                # assign the new reports to the nearest available workers
+                if adds and service.get('auto dispatch'):
+                    settings = service['auto dispatch']
+                    workers, workloads = load_workers(settings, fl_target, gis, out_sr)
+                    dispatched = dispatch(adds, settings, workers, workloads)
+                    log.write('Dispatched {} of {} new assignments\n'.format(dispatched, len(adds)))
 
                 # add records to target layer
-                if adds:
-                    add_result = fl_target.edit_features(adds=adds)
-                    for result in add_result['updateResults']:
-                        if not result['success']:
-                            raise Exception('error {}: {}'.format(result['error']['code'],
-                                                                  result['error']['description']))
-
-                # update records:
-                if updates:
-                    update_result = fl_source.edit_features(updates=updates)
-                    for result in update_result['updateResults']:
-                        if not result['success']:
-                            raise Exception('error {}: {}'.format(result['error']['code'],
-                                                                  result['error']['description']))
+                created = add_assignments(fl_target, adds, log) if adds else []
+
+                if duplicates:
+                    log.write('Skipped {} duplicate reports\n'.format(len(duplicates)))
+
+                # update only the records whose assignments were created, and the duplicates of
+                # an open assignment on the server or of a report whose assignment was created
+                created_set = set(created)
+                handled = [sources[index] for index in created] + \
+                          [oid for oid, matches in duplicates
+                           if any(match is None or match in created_set for match in matches)]
+                if service['update field'] and handled:
+                    updates = [{'attributes': {oid_field: oid,
+                                               service['update field']: service['update value']}}
+                               for oid in handled]
+                    for chunk in _chunks(updates, chunk_size):
+                        update_result = governor.call(fl_source.url, fl_source.edit_features, updates=chunk)
+                        for result in update_result['updateResults']:
+                            if not result['success']:
+                                msg = 'error {}: {}'.format(result['error']['code'], result['error']['description'])
+                                print(msg)
+                                log.write('{}\n'.format(msg))
 
             except Exception as ex:
-                msg = 'Failed to copy feature from layer {}'.format(service['url'])
+                msg = 'Failed to copy feature from layer {}'.format(service['source url'])
                 print(ex)
                 print(msg)
                 log.write('{}\n{}\n'.format(msg, ex))
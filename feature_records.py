@@ -0,0 +1,118 @@
+# ------------------------------------------------------------------------------
+# Name:        feature_records.py
+# Purpose:     Compact in-memory records for the features processed by the
+#              scripts in this repository
+
+# Copyright 2017 Esri
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# ------------------------------------------------------------------------------
+
+import sys
+
+from request_governor import governor
+
+
+class RecordSchema(object):
+    """Field names shared by all records of a query. Names are interned so
+    that every record refers to the same strings"""
+
+    __slots__ = ('fields', 'index')
+
+    def __init__(self, fields):
+        self.fields = tuple(sys.intern(str(field)) for field in fields)
+        self.index = dict((field, i) for i, field in enumerate(self.fields))
+
+
+class FeatureRecord(object):
+    """Values of the queried fields of one feature, in schema order, with
+    the feature geometry. Points are held as an (x, y) tuple.
+    Fields changed with set_value are tracked so that edits only send the
+    values that changed."""
+
+    __slots__ = ('schema', 'values', '_geometry', 'changed')
+
+    def __init__(self, schema, values, geometry=None):
+        self.schema = schema
+        self.values = values
+        if geometry and set(geometry.keys()) <= {'x', 'y', 'spatialReference'} and 'x' in geometry:
+            geometry = (geometry['x'], geometry['y'])
+        self._geometry = geometry
+        self.changed = None
+
+    @property
+    def fields(self):
+        return self.schema.fields
+
+    @property
+    def attributes(self):
+        """A new dict of the record values. Changes to the dict are not kept,
+        use set_value instead"""
+        return dict(zip(self.schema.fields, self.values))
+
+    @property
+    def geometry(self):
+        if isinstance(self._geometry, tuple):
+            return {'x': self._geometry[0], 'y': self._geometry[1]}
+        return self._geometry
+
+    def get_value(self, field, default=None):
+        try:
+            return self.values[self.schema.index[field]]
+        except KeyError:
+            return default
+
+    def set_value(self, field, value):
+        index = self.schema.index[field]
+        self.values[index] = value
+        if self.changed is None:
+            self.changed = set()
+        self.changed.add(index)
+
+    def as_update(self, oid_field):
+        """Return an attribute-only edit payload with the changed values"""
+        attributes = {oid_field: self.get_value(oid_field)}
+        for index in self.changed or ():
+            attributes[self.schema.fields[index]] = self.values[index]
+        return {'attributes': attributes}
+
+
+def to_records(features, schema=None):
+    """Convert arcgis Feature objects to FeatureRecords sharing one schema.
+    Returns the records and the schema"""
+
+    records = []
+    for feature in features:
+        attributes = feature.attributes
+        if schema is None:
+            schema = RecordSchema(attributes.keys())
+        records.append(FeatureRecord(schema, [attributes.get(field) for field in schema.fields], feature.geometry))
+    return records, schema
+
+
+def query_records(layer, schema=None, **kwargs):
+    """Query a layer a page at a time through the request governor, converting
+    each page to FeatureRecords so that Feature objects of earlier pages can be
+    released. Pages are at most the maxRecordCount of the layer.
+    Returns the records and the schema"""
+
+    limit = layer.properties['maxRecordCount']
+    if not limit or limit < 1:
+        limit = 1000
+    records = []
+    for features in governor.query_pages(layer, limit, **kwargs):
+        page, schema = to_records(features, schema)
+        records += page
+        del features
+    return records, schema
@@ -0,0 +1,204 @@
+# ------------------------------------------------------------------------------
+# Name:        leases.py
+# Purpose:     Share the services of a configuration between several worker
+#              processes or machines using time-limited leases
+
+# Copyright 2017 Esri
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# ------------------------------------------------------------------------------
+
+from threading import Event, Lock, Thread
+from hashlib import md5
+from time import time, sleep
+import socket
+import sqlite3
+import os
+
+
+class LeaseBackend(object):
+    """Store shared by all workers. A lease on a resource is held by one
+    worker until it expires. Subclass this to keep leases in a store other
+    than SQLite"""
+
+    def claim(self, resource, worker, expires, now):
+        """Take or extend the lease on a resource if it is free, expired or
+        already held by the worker. Returns True if the worker holds it"""
+        raise NotImplementedError
+
+    def renew(self, worker, expires, now):
+        """Extend the heartbeat of a worker and every unexpired lease it holds"""
+        raise NotImplementedError
+
+    def release(self, worker, resource=None):
+        """Give up one lease of a worker, or all of them and its heartbeat"""
+        raise NotImplementedError
+
+    def live_workers(self, now):
+        """Return the number of workers with an unexpired heartbeat"""
+        raise NotImplementedError
+
+    def get_value(self, name):
+        raise NotImplementedError
+
+    def set_value(self, name, value):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """Leases held in a SQLite database. To share services between machines,
+    keep the database on a file share that all of them can write to"""
+
+    def __init__(self, db_path, timeout=30):
+        self._db = sqlite3.connect(db_path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = Lock()
+        self._db.execute("CREATE TABLE IF NOT EXISTS leases (resource TEXT PRIMARY KEY, worker TEXT, expires REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, expires REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def claim(self, resource, worker, expires, now):
+        with self._lock:
+            cursor = self._db.execute("INSERT INTO leases (resource, worker, expires) VALUES (?, ?, ?) "
+                                      "ON CONFLICT(resource) DO UPDATE SET worker = excluded.worker, "
+                                      "expires = excluded.expires "
+                                      "WHERE leases.worker = excluded.worker OR leases.expires < ?",
+                                      (resource, worker, expires, now))
+            return cursor.rowcount == 1
+
+    def renew(self, worker, expires, now):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO workers (worker, expires) VALUES (?, ?)", (worker, expires))
+            self._db.execute("UPDATE leases SET expires = ? WHERE worker = ? AND expires >= ?",
+                             (expires, worker, now))
+
+    def release(self, worker, resource=None):
+        with self._lock:
+            if resource is None:
+                self._db.execute("DELETE FROM leases WHERE worker = ?", (worker,))
+                self._db.execute("DELETE FROM workers WHERE worker = ?", (worker,))
+            else:
+                self._db.execute("DELETE FROM leases WHERE worker = ? AND resource = ?", (worker, resource))
+
+    def live_workers(self, now):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM workers WHERE expires >= ?", (now,)).fetchone()[0]
+
+    def get_value(self, name):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_value(self, name, value):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, value))
+
+    def close(self):
+        self._db.close()
+
+
+class LeaseManager(object):
+    """Claims leases for one worker and renews them in the background while
+    the worker runs. Use as a context manager, or call start and stop; all
+    leases are released when it stops.
+
+    Each worker claims at most its fair share of the resources: the total
+    divided by the number of live workers. Workers prefer different resources
+    by ranking them on a hash of the worker and resource names. When a worker
+    stops renewing, its leases expire after ttl seconds and the remaining
+    workers take them on their next run."""
+
+    def __init__(self, backend, worker=None, ttl=300):
+        self.backend = backend
+        self.worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.held = set()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        """Register the worker and start renewing its leases"""
+        self.backend.renew(self.worker, time() + self.ttl, time())
+        self._thread = Thread(target=self._renew, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop renewing and release all leases of the worker"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.backend.release(self.worker)
+        self.held.clear()
+        self.backend.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3.0):
+            try:
+                self.backend.renew(self.worker, time() + self.ttl, time())
+            except Exception:
+                # a busy or unreachable store is retried on the next heartbeat
+                pass
+
+    def _rank(self, resource):
+        return md5('{}|{}'.format(self.worker, resource).encode('utf-8')).hexdigest()
+
+    def claim(self, resource):
+        if self.backend.claim(resource, self.worker, time() + self.ttl, time()):
+            self.held.add(resource)
+            return True
+        return False
+
+    def release(self, resource):
+        self.backend.release(self.worker, resource)
+        self.held.discard(resource)
+
+    def lock(self, resource, wait=60):
+        """Claim a lease, waiting up to wait seconds for another worker to
+        release it. Returns True if the lease was claimed"""
+        deadline = time() + wait
+        while not self.claim(resource):
+            if time() >= deadline:
+                return False
+            sleep(1)
+        return True
+
+    def acquire(self, items, key):
+        """Yield the items this worker claims a lease on, up to its fair share.
+        key returns the resource name of an item"""
+        ranked = sorted(items, key=lambda item: self._rank(key(item)))
+        claimed = 0
+        for item in ranked:
+            share = -(-len(ranked) // max(1, self.backend.live_workers(time())))
+            if claimed >= share:
+                break
+            if self.claim(key(item)):
+                claimed += 1
+                yield item
+
+
+def open_leases(settings):
+    """Return a LeaseManager for the 'leases' settings of a configuration,
+    or None if leases are not configured"""
+    if not settings or not settings.get('store'):
+        return None
+    return LeaseManager(SQLiteLeaseBackend(settings['store']), settings.get('worker'), settings.get('ttl', 300))
@@ -0,0 +1,273 @@
+# ------------------------------------------------------------------------------
+# Name:        request_governor.py
+# Purpose:     Pace the requests sent to ArcGIS and Cityworks servers, size
+#              query pages and edit batches to the server response, and back
+#              off when the server throttles
+
+# Copyright 2017 Esri
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# ------------------------------------------------------------------------------
+
+from urllib.parse import urlparse
+from threading import Lock
+from time import time, sleep
+import random
+import socket
+import re
+import requests
+from urllib3.exceptions import NewConnectionError
+
+throttle_statuses = [429, 503]
+
+# The ArcGIS API for Python reports the error code returned by the server
+# at the end of the exception message
+error_code = re.compile(r'\(Error Code: (\d+)\)')
+
+
+def status_code(error):
+    """Return the HTTP or ArcGIS error code of an exception or response, or None"""
+    if isinstance(error, requests.Response):
+        return error.status_code
+    response = getattr(error, 'response', None)
+    if isinstance(response, requests.Response):
+        return response.status_code
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code
+    match = error_code.search(str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_throttled(error):
+    """Return True if an exception or response signals that the server is throttling"""
+    return status_code(error) in throttle_statuses
+
+
+def is_timeout(error):
+    """Return True if an exception is a request that timed out"""
+    return isinstance(error, (requests.exceptions.Timeout, socket.timeout, TimeoutError)) or \
+        status_code(error) in (504, 524)
+
+
+def is_connection_failure(error):
+    """Return True if an exception is a failure to connect to the server,
+    so the request was never sent"""
+    if isinstance(error, (requests.exceptions.ConnectTimeout, ConnectionRefusedError)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class EditError(Exception):
+    """Raised by apply_edits when a batch fails. results holds the edit
+    results of the batches that were sent before it"""
+
+    def __init__(self, error, results):
+        super(EditError, self).__init__(str(error))
+        self.error = error
+        self.results = results
+
+
+class TokenBucket(object):
+    """Allows rate requests per second with bursts of up to capacity requests.
+    The rate is halved each time the server throttles, and recovers in small
+    steps with each successful request"""
+
+    def __init__(self, rate, capacity):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time()
+        self.paused_until = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        """Wait for a token"""
+        while True:
+            with self._lock:
+                now = time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def throttled(self, delay):
+        """Slow down and pause all requests to the host for delay seconds"""
+        with self._lock:
+            self.rate = max(self.max_rate / 20, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time() + delay)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RequestGovernor(object):
+    """Shared by all requests of a script.
+
+    rate - requests per second allowed to each host
+    burst - requests that can be sent at once after a quiet period
+    retries - times a throttled request is sent again
+    backoff - seconds waited after the first throttled response, doubled for each retry
+    max_backoff - longest wait after a throttled response, in seconds
+    target_seconds - response time aimed for when sizing pages and edit batches
+    max_payload - largest query page aimed for, in bytes
+    min_page - smallest page or edit batch
+    """
+
+    def __init__(self, rate=50, burst=20, retries=5, backoff=2, max_backoff=120, target_seconds=5,
+                 max_payload=5000000, min_page=50):
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.target_seconds = target_seconds
+        self.max_payload = max_payload
+        self.min_page = min_page
+        self._buckets = {}
+        self._pages = {}
+        self._lock = Lock()
+
+    def configure(self, settings):
+        """Apply the 'request governor' settings of a configuration file"""
+        for key, value in (settings or {}).items():
+            setattr(self, key.replace(' ', '_'), value)
+        with self._lock:
+            self._buckets = {}
+
+    def _bucket(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(self.max_backoff, float(retry_after))
+            except ValueError:
+                pass
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+
+    def call(self, url, func, *args, **kwargs):
+        """Call func, an ArcGIS API request to url, when the rate limit of
+        the host allows. Throttled calls are retried after a backoff"""
+        bucket = self._bucket(url)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as error:
+                if attempt == self.retries or not is_throttled(error):
+                    raise
+                bucket.throttled(self._delay(attempt))
+                continue
+            bucket.succeeded()
+            return result
+
+    def request(self, method, url, retry=True, session=None, **kwargs):
+        """Send an HTTP request with requests, or with a requests session, when
+        the rate limit of the host allows. Throttled requests are sent again
+        after a backoff, unless retry is False because the body can only be
+        read once"""
+        bucket = self._bucket(url)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            response = (session or requests).request(method, url, **kwargs)
+            if not is_throttled(response):
+                bucket.succeeded()
+                return response
+            bucket.throttled(self._delay(attempt, response.headers.get('Retry-After')))
+            if not retry or attempt == self.retries:
+                return response
+            response.close()
+
+    def page_size(self, key, limit):
+        """Return the page or batch size to use next for key, at most limit"""
+        with self._lock:
+            size = self._pages.get(key, limit)
+        return max(1, min(size, limit))
+
+    def observe(self, key, size, limit, count, seconds, payload=None):
+        """Grow or shrink the page size of key from the time taken and bytes
+        returned by a page of count items requested with size"""
+        if seconds > self.target_seconds or (payload and payload > self.max_payload):
+            size = max(min(self.min_page, limit), size // 2)
+        elif count >= size and seconds < self.target_seconds / 2 and \
+                (not payload or payload < self.max_payload / 2):
+            size = min(limit, size + size // 2 + 1)
+        with self._lock:
+            self._pages[key] = size
+
+    def query_pages(self, layer, limit, **kwargs):
+        """Query a layer a page at a time. Yields the features of each page"""
+        key = (layer.url, 'query')
+        offset = 0
+        while True:
+            size = self.page_size(key, limit)
+            start = time()
+            try:
+                features = self.call(layer.url, layer.query, result_offset=offset, result_record_count=size,
+                                     **kwargs).features
+            except Exception as error:
+                # a slow server may fail large pages, try once more with a smaller page
+                if size <= self.min_page or not (is_throttled(error) or is_timeout(error)):
+                    raise
+                self.observe(key, size, limit, 0, float('inf'))
+                continue
+            seconds = time() - start
+            payload = len(str(features[0].attributes)) * len(features) if features else 0
+            self.observe(key, size, limit, len(features), seconds, payload)
+            yield features
+            if len(features) < size:
+                break
+            offset += len(features)
+
+    def apply_edits(self, layer, adds=None, updates=None, limit=1000):
+        """Send adds and updates to a layer in batches sized to the server
+        response. Returns the combined edit results. If a batch fails, raises
+        an EditError with the results of the batches already applied"""
+        key = (layer.url, 'edit')
+        results = {'addResults': [], 'updateResults': [], 'deleteResults': []}
+        for name, edits in (('adds', adds), ('updates', updates)):
+            edits = list(edits or [])
+            position = 0
+            while position < len(edits):
+                size = self.page_size(key, limit)
+                batch = edits[position:position + size]
+                start = time()
+                try:
+                    result = self.call(layer.url, layer.edit_features, **{name: batch})
+                except Exception as error:
+                    raise EditError(error, results) from error
+                self.observe(key, size, limit, len(batch), time() - start)
+                for result_name in results:
+                    results[result_name] += result.get(result_name, [])
+                position += len(batch)
+        return results
+
+
+governor = RequestGovernor()
@@ -19,10 +19,16 @@
 # ------------------------------------------------------------------------------
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import smtplib, sys
+import smtplib, sys, csv, json
+from os import path
 
 class EmailServer(object):
     def __init__(self, smtp_server, smtp_username=None, smtp_password=None, use_tls=False):
+        self._settings = (smtp_server, smtp_username, smtp_password, use_tls)
+        self.connect()
+
+    def connect(self):
+        smtp_server, smtp_username, smtp_password, use_tls = self._settings
         self._server = smtplib.SMTP(smtp_server)
         if use_tls:
             self._server.starttls()
@@ -31,6 +37,13 @@ class EmailServer(object):
             self._server.esmtp_features['auth'] = 'LOGIN'
             self._server.login(smtp_username, smtp_password)
 
+    def reconnect(self):
+        try:
+            self._server.close()
+        except Exception:
+            pass
+        self.connect()
+
     def __enter__(self):
         return self
 
@@ -55,7 +68,10 @@ class EmailServer(object):
         self._server.sendmail(from_address, recipients, msg.as_string())
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._server.quit()
+        try:
+            self._server.quit()
+        except smtplib.SMTPServerDisconnected:
+            pass
 
 def _add_warning(message):
     try:
@@ -71,7 +87,95 @@ def _set_result(index, value):
     except ImportError:
         pass
 
-if __name__ == "__main__":
+def _addresses(value):
+    """Return a list of addresses from a list or a ; separated string"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(';')
+    return [address.strip() for address in value if address.strip() not in ('', '#')]
+
+def read_messages(source):
+    """Yield the line number and fields of each message in a CSV file, or
+    the line number and text of each line of a JSON lines file. Lines are
+    parsed by send_batch so that a bad line only fails its own message.
+    Use - to read JSON lines from stdin"""
+    if source == '-':
+        lines = sys.stdin
+    else:
+        lines = open(source, newline='')
+    try:
+        if source.lower().endswith('.csv'):
+            for number, message in enumerate(csv.DictReader(lines), 2):
+                yield number, message
+        else:
+            for number, line in enumerate(lines, 1):
+                if line.strip():
+                    yield number, line
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+def send_batch(email_server, messages, results):
+    """Send messages over one connection. If the server drops the
+    connection, reconnect and send the message again once.
+    Writes the result of each message as a line of JSON to results.
+    Returns the number of messages sent and failed"""
+    sent = failed = 0
+    for number, message in messages:
+        result = {'line': number, 'id': None, 'success': False}
+        try:
+            if isinstance(message, str):
+                message = json.loads(message)
+                if not isinstance(message, dict):
+                    raise ValueError("Line {0} is not a JSON object".format(number))
+            result['id'] = message.get('id')
+            args = (message.get('from_address', ''),
+                    message.get('reply_to', ''),
+                    _addresses(message.get('to_addresses')),
+                    _addresses(message.get('cc_addresses')),
+                    _addresses(message.get('bcc_addresses')),
+                    message.get('subject', ''),
+                    message.get('email_body', ''))
+            try:
+                email_server.send(*args)
+            except smtplib.SMTPServerDisconnected:
+                email_server.reconnect()
+                email_server.send(*args)
+            result['success'] = True
+            sent += 1
+        except Exception as e:
+            result['error'] = str(e)
+            failed += 1
+        results.write(json.dumps(result) + '\n')
+        results.flush()
+    return sent, failed
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "--batch":
+    # send_email.py --batch smtp_server smtp_username smtp_password use_tls messages [results]
+    smtp_server, smtp_username, smtp_password = sys.argv[2:5]
+    use_tls = sys.argv[5].lower() in ('true', 'yes', '1')
+    source = sys.argv[6]
+    if len(sys.argv) > 7:
+        results = open(sys.argv[7], 'w')
+    elif source == '-':
+        results = sys.stdout
+    else:
+        results = open(path.splitext(source)[0] + '_results.jsonl', 'w')
+
+    try:
+        with EmailServer(smtp_server, smtp_username, smtp_password, use_tls) as email_server:
+            sent, failed = send_batch(email_server, read_messages(source), results)
+        if failed:
+            _add_warning("Sent {0} e-mails, {1} failed.".format(sent, failed))
+    except Exception as e:
+        _add_warning("Failed to send e-mails. {0}".format(str(e)))
+        sys.exit(1)
+    finally:
+        if results is not sys.stdout:
+            results.close()
+
+elif __name__ == "__main__":
     smtp_server = sys.argv[1]
     smtp_username = sys.argv[2]
     smtp_password = sys.argv[3]
@@ -19,15 +19,21 @@
 # ------------------------------------------------------------------------------
 
 from send_email import EmailServer
+from feature_records import to_records
+from leases import open_leases
+from request_governor import governor, EditError
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 import re
 from datetime import datetime as dt
-from os import path, sys
+from os import path, sys, replace
 from arcgis.gis import GIS
 from arcgis.features import FeatureLayer
 import json
 
 #id_settings = {}
 #modlists = {}
+enrichment_cache = None
 
 
 def _add_message(msg, ertype='ERROR'):
@@ -44,28 +50,28 @@ def _report_failures(results):
     return
 
 
-def _get_features(feature_layer, where_clause, return_geometry=False):
-    """Get the features for the given feature layer of a feature service. Returns a list of json features.
+def _get_features(feature_layer, where_clause, return_geometry=False, out_fields='*'):
+    """Get the features for the given feature layer of a feature service. Returns a list of FeatureRecords
+    sharing one schema. Pages are sized by the request governor, up to the maxRecordCount of the layer.
     Keyword arguments:
     feature_layer - The feature layer to return the features for
-    where_clause - The expression used in the query"""
+    where_clause - The expression used in the query
+    out_fields - Comma-separated list of the fields to return"""
 
     total_features = []
+    schema = None
     max_record_count = feature_layer.properties['maxRecordCount']
     if max_record_count < 1:
         max_record_count = 1000
-    offset = 0
-    while True:
-        if not where_clause:
-            where_clause = "1=1"
-        features = feature_layer.query(where=where_clause,
-                                       return_geometry=return_geometry,
-                                       result_offset=offset,
-                                       result_record_count=max_record_count).features
-        total_features += features
-        if len(features) < max_record_count:
-            break
-        offset += len(features)
+    if not where_clause:
+        where_clause = "1=1"
+    for features in governor.query_pages(feature_layer, max_record_count,
+                                         where=where_clause,
+                                         out_fields=out_fields,
+                                         return_geometry=return_geometry):
+        records, schema = to_records(features, schema)
+        total_features += records
+        del features
     return total_features
 
 
@@ -78,20 +84,115 @@ def add_identifiers(lyr, seq, fld):
     fmt = id_settings[seq]['pattern']
     interval = id_settings[seq]['interval']
 
-    rows = _get_features(lyr, """{} is null""".format(fld))
+    oid_field = lyr.properties.objectIdField
+    rows = _get_features(lyr, """{} is null""".format(fld), out_fields='{},{}'.format(oid_field, fld))
 
     # For each feature, update id, and increment sequence value
     for row in rows:
-        row.attributes[fld] = fmt.format(value)
+        row.set_value(fld, fmt.format(value))
         value += interval
 
     if rows:
-        results = lyr.edit_features(updates=rows)
+        try:
+            results = governor.apply_edits(lyr, updates=[row.as_update(oid_field) for row in rows])
+        except EditError as ex:
+            # the batches sent before the failure are written, so the sequence
+            # continues after the last row sent and those values are not given out again
+            _add_message('Failed to update identifiers in {}\n{}'.format(lyr.url, ex))
+            results = ex.results
+            value = id_settings[seq]['next value'] + len(results['updateResults']) * interval
         _report_failures(results)
 
     return value
 
 
+# Geographic coordinate systems have coordinates in degrees
+geographic_wkids = (range(4000, 5000), range(37001, 37300), range(104000, 105000))
+meters_per_degree = 111320.0
+
+
+def _is_geographic(spatial_reference):
+    wkid = spatial_reference.get('latestWkid', spatial_reference.get('wkid'))
+    if wkid:
+        return any(wkid in wkids for wkids in geographic_wkids)
+    return str(spatial_reference.get('wkt', '')).upper().startswith('GEOGCS')
+
+
+class EnrichmentCache(object):
+    """Enrichment values of locations seen in earlier runs, kept in a JSON file.
+    Locations are rounded to a grid of cells precision meters wide, converted
+    to degrees for geographic spatial references. Every location in a cell
+    gets the value cached for the cell, so a report up to one cell diagonal
+    from a polygon boundary can get the value of the neighbouring polygon.
+    Values are keyed on the reference layer, its last edit date and the grid
+    cell, so an edit to the reference layer invalidates its values. Locations
+    outside all reference polygons are cached as well.
+    The least recently used values are dropped beyond max_entries."""
+
+    def __init__(self, cache_file, precision=1.0, max_entries=100000):
+        self.cache_file = cache_file
+        self.precision = float(precision)
+        self.max_entries = int(max_entries)
+        self.changed = False
+        self._cells = {}
+        self._values = OrderedDict()
+        try:
+            with open(cache_file) as cachereader:
+                self._values.update(json.load(cachereader)['values'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def add_layer(self, layer, spatial_reference):
+        """Set the cell size of a layer key from the units of the spatial
+        reference its locations are in"""
+        cell = self.precision
+        if _is_geographic(spatial_reference):
+            cell /= meters_per_degree
+        self._cells[layer] = cell
+
+    def key(self, layer, x, y):
+        cell = self._cells.get(layer, self.precision)
+        return '{}|{}|{}'.format(layer, int(round(x / cell)), int(round(y / cell)))
+
+    def get(self, layer, x, y):
+        """Return (True, value) for a cached location, or (False, None)"""
+        key = self.key(layer, x, y)
+        if key not in self._values:
+            return False, None
+        self._values.move_to_end(key)
+        return True, self._values[key]
+
+    def put(self, layer, x, y, value):
+        key = self.key(layer, x, y)
+        self._values[key] = value
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_entries:
+            self._values.popitem(last=False)
+        self.changed = True
+
+    def save(self):
+        temp_file = '{}.tmp'.format(self.cache_file)
+        with open(temp_file, 'w') as cachewriter:
+            json.dump({'values': list(self._values.items())}, cachewriter)
+        replace(temp_file, self.cache_file)
+        self.changed = False
+
+
+def _cache_layer(source, field, spatial_reference):
+    """Return the cache key of a reference layer and field, or None if the
+    last edit date of the layer is not known"""
+    try:
+        version = source.properties.editingInfo.lastEditDate
+    except (AttributeError, KeyError):
+        return None
+    if not version:
+        return None
+    wkid = spatial_reference.get('latestWkid', spatial_reference.get('wkid'))
+    layer = '{}|{}|{}|{}|{}'.format(source.url, field, version, wkid, enrichment_cache.precision)
+    enrichment_cache.add_layer(layer, spatial_reference)
+    return layer
+
+
 def enrich_layer(source, target, settings):
     wkid = source.properties.extent.spatialReference.wkid
 
@@ -101,9 +202,35 @@ def enrich_layer(source, target, settings):
             sql += " AND {}".format(settings['sql'])
 
     rows = _get_features(target, sql, return_geometry=True)
+    if not rows:
+        return
+
+    # Resolve locations seen in earlier runs from the cache, and only query
+    # the reference polygons for new locations
+    spatial_reference = target.properties.extent.spatialReference
+    cache_layer = _cache_layer(source, settings['source'], spatial_reference) if enrichment_cache else None
+    if cache_layer:
+        oid_field = target.properties.objectIdField
+        unresolved = []
+        for row in rows:
+            if not row.geometry:
+                continue
+            found, value = enrichment_cache.get(cache_layer, row.geometry['x'], row.geometry['y'])
+            if not found:
+                unresolved.append(row)
+            elif value is not None:
+                row.set_value(settings['target'], value)
+
+        updates = [row.as_update(oid_field) for row in rows if row.changed]
+        if updates:
+            results = governor.apply_edits(target, updates=updates)
+            _report_failures(results)
+        if not unresolved:
+            return
+        matched = set()
 
     # Query for source polygons
-    source_polygons = source.query(out_fields=settings['source'])
+    source_polygons = governor.call(source.url, source.query, out_fields=settings['source'])
 
     for polygon in source_polygons:
         polyGeom = {
@@ -114,19 +241,120 @@ def enrich_layer(source, target, settings):
         }
 
         #Query find points that intersect the source polygon and that honor the sql query from settings
-        intersectingPoints = target.query(geometry_filter=polyGeom, where=sql, out_fields=settings['target'])
+        intersectingPoints = governor.call(target.url, target.query, geometry_filter=polyGeom, where=sql,
+                                           out_fields=settings['target'])
 
         source_val = polygon.get_value(settings['source'])
 
         #Set all of the intersecting points values
         for feature in intersectingPoints:
             feature.set_value(settings['target'],source_val)
+            if cache_layer and feature.geometry:
+                enrichment_cache.put(cache_layer, feature.geometry['x'], feature.geometry['y'], source_val)
+                matched.add(enrichment_cache.key(cache_layer, feature.geometry['x'], feature.geometry['y']))
 
         #Send edits if they exist
         if intersectingPoints:
-            results = target.edit_features(updates=intersectingPoints)
+            results = governor.apply_edits(target, updates=intersectingPoints.features)
             _report_failures(results)
 
+    # remember the new locations that are outside all reference polygons
+    if cache_layer:
+        for row in unresolved:
+            x, y = row.geometry['x'], row.geometry['y']
+            if enrichment_cache.key(cache_layer, x, y) not in matched:
+                enrichment_cache.put(cache_layer, x, y, None)
+
+    return
+
+
+def _point_in_polygon(x, y, polygon):
+    """Even-odd test of a point against all rings of a polygon, so that
+    points in holes are excluded"""
+    inside = False
+    for ring in polygon['rings']:
+        for i in range(len(ring) - 1):
+            x1, y1 = ring[i][:2]
+            x2, y2 = ring[i + 1][:2]
+            if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                inside = not inside
+    return inside
+
+
+def _load_polygons(source, field, wkid):
+    """Return the polygons of a reference layer as (extent, geometry, value)"""
+    polygons = []
+    for polygon in governor.call(source.url, source.query, out_fields=field, out_sr=wkid):
+        if not polygon.geometry or not polygon.geometry.get('rings'):
+            continue
+        xs = [pt[0] for ring in polygon.geometry['rings'] for pt in ring]
+        ys = [pt[1] for ring in polygon.geometry['rings'] for pt in ring]
+        polygons.append(((min(xs), min(ys), max(xs), max(ys)), polygon.geometry, polygon.get_value(field)))
+    return polygons
+
+
+def enrich_service(target, enrich_settings, gis):
+    """Enrich a layer from all of its reference layers in a single pass.
+    The unenriched features are queried once, each reference layer is queried
+    once, and every enriched value is sent in one combined update.
+    Settings are applied in priority order, and a field is only filled by
+    the first reference layer that matches the point"""
+
+    spatial_reference = target.properties.extent.spatialReference
+    wkid = spatial_reference.wkid
+    oid_field = target.properties.objectIdField
+
+    targets = set(setting['target'] for setting in enrich_settings)
+    sql = ' OR '.join('{} IS NULL'.format(field) for field in targets)
+    rows = _get_features(target, '({})'.format(sql), return_geometry=True,
+                         out_fields=','.join([oid_field] + sorted(targets)))
+    if not rows:
+        return
+
+    for settings in enrich_settings:
+        field = settings['target']
+
+        # features that meet the optional query of this setting
+        eligible = None
+        if settings.get('sql') and settings['sql'] != '1=1':
+            result = governor.call(target.url, target.query,
+                                   where='{} IS NULL AND {}'.format(field, settings['sql']), return_ids_only=True)
+            eligible = set(result['objectIds'] or [])
+
+        source = FeatureLayer(settings['url'], gis)
+        cache_layer = _cache_layer(source, settings['source'], spatial_reference) if enrichment_cache else None
+
+        # the reference polygons are only queried if a location is not cached
+        polygons = None
+
+        for row in rows:
+            if row.get_value(field) is not None or (eligible is not None and row.get_value(oid_field) not in eligible):
+                continue
+            if not row.geometry:
+                continue
+            x, y = row.geometry['x'], row.geometry['y']
+            if cache_layer:
+                found, value = enrichment_cache.get(cache_layer, x, y)
+                if found:
+                    if value is not None:
+                        row.set_value(field, value)
+                    continue
+            if polygons is None:
+                polygons = _load_polygons(source, settings['source'], wkid)
+            match = None
+            for extent, geometry, value in polygons:
+                if extent[0] <= x <= extent[2] and extent[1] <= y <= extent[3] and _point_in_polygon(x, y, geometry):
+                    row.set_value(field, value)
+                    match = value
+                    break
+            if cache_layer:
+                enrichment_cache.put(cache_layer, x, y, match)
+
+    updates = [row.as_update(oid_field) for row in rows if row.changed]
+    if updates:
+        results = governor.apply_edits(target, updates=updates)
+        _report_failures(results)
+
     return
 
 
@@ -160,9 +388,11 @@ def build_expression(words, match_type, subs):
 
 
 def moderate_features(lyr, settings):
-    rows = _get_features(lyr, settings['sql'])
+    oid_field = lyr.properties.objectIdField
+    scan_fields = settings['scan fields'].split(';')
+    rows = _get_features(lyr, settings['sql'], out_fields=','.join([oid_field, settings['field']] + scan_fields))
     for row in rows:
-        for field in settings['scan fields'].split(';'):
+        for field in scan_fields:
             try:
                 text = row.get_value(field)
                 text = text.upper()
@@ -170,17 +400,64 @@ def moderate_features(lyr, settings):
                 continue
 
             if re.search(modlists[settings['list']], text):
-                row.attributes[settings['field']] = settings['value']
+                row.set_value(settings['field'], settings['value'])
                 break
 
-    if rows:
-        results = lyr.edit_features(updates=rows)
+    updates = [row.as_update(oid_field) for row in rows if row.changed]
+    if updates:
+        results = governor.apply_edits(lyr, updates=updates)
+        _report_failures(results)
+    return
+
+
+def _init_moderation_worker(expressions):
+    """Compile the moderation lists once in each worker process"""
+    global compiled_lists
+    compiled_lists = dict((name, re.compile(expression)) for name, expression in expressions.items())
+
+
+def _moderate_shard(shard):
+    """Return the ObjectIDs of the rows in a shard that match a moderation list"""
+    list_name, rows = shard
+    expression = compiled_lists[list_name]
+    flagged = []
+    for oid, texts in rows:
+        for text in texts:
+            if text and expression.search(text.upper()):
+                flagged.append(oid)
+                break
+    return flagged
+
+
+def moderate_features_parallel(lyr, settings, pool, processes):
+    """Moderate features on a pool of worker processes. Only the ObjectID and
+    scan field values of each row are sent to the workers, and only the
+    ObjectIDs of flagged rows are returned and updated"""
+
+    oid_field = lyr.properties.objectIdField
+    scan_fields = settings['scan fields'].split(';')
+    rows = _get_features(lyr, settings['sql'], out_fields=','.join([oid_field] + scan_fields))
+
+    texts = [(row.get_value(oid_field),
+              [value if isinstance(value, str) else None for value in (row.get_value(field) for field in scan_fields)])
+             for row in rows]
+    del rows
+
+    size = max(1, len(texts) // (processes * 4) + 1)
+    shards = [(settings['list'], texts[i:i + size]) for i in range(0, len(texts), size)]
+
+    updates = []
+    for flagged in pool.map(_moderate_shard, shards):
+        updates += [{'attributes': {oid_field: oid, settings['field']: settings['value']}} for oid in flagged]
+
+    if updates:
+        results = governor.apply_edits(lyr, updates=updates)
         _report_failures(results)
     return
 
 
 def _get_value(row, fields, sub):
-    val = row.attributes[sub]
+    val = row.get_value(sub)
 
     if val is None:
         val = ''
@@ -189,10 +466,10 @@ def _get_value(row, fields, sub):
             if field['name'] == sub and 'Date' in field['type']:
                 try:
                     val = dt.fromtimestamp(
-                        row.attributes[sub]).strftime('%c')
+                        val).strftime('%c')
                 except OSError:  # timestamp in milliseconds
                     val = dt.fromtimestamp(
-                        row.attributes[sub] / 1000).strftime('%c')
+                        val / 1000).strftime('%c')
                 break
         else:
             val = str(val)
@@ -205,7 +482,7 @@ def build_email(row, fields, settings):
     email_body = ''
 
     if settings['recipient'] in row.fields:
-        email = row.attributes[settings['recipient']]
+        email = row.get_value(settings['recipient'])
     else:
         email = settings['recipient']
 
@@ -230,14 +507,33 @@ def build_email(row, fields, settings):
     return email, email_subject, email_body
 
 
+def _shard_settings(settings, oid_field, shard, shards):
+    """Limit the query of moderation or email settings to one shard of the ObjectIDs"""
+    if shards < 2:
+        return settings
+    sql = settings['sql'] if settings.get('sql') else '1=1'
+    return dict(settings, sql='({}) AND MOD({}, {}) = {}'.format(sql, oid_field, shards, shard))
+
+
+def _lease_name(work):
+    service, shard, shards = work
+    return service['url'] if shards < 2 else '{}#{}'.format(service['url'], shard)
+
+
 def main(configuration_file):
 
+    moderation_pool = None
+    leases = None
+    used_sequences = set()
     try:
         with open(configuration_file) as configfile:
             cfg = json.load(configfile)
 
         gis = GIS(cfg['organization url'], cfg['username'], cfg['password'])
 
+        # Pace requests to each server, and back off when a server throttles
+        governor.configure(cfg.get('request governor'))
+
         # Get general id settings
         global id_settings
         id_settings = {}
@@ -254,6 +550,13 @@ def main(configuration_file):
             words = [str(word).upper().strip() for word in modlist['words'].split(',')]
             modlists[modlist['filter name']] = build_expression(words, modlist['filter type'], subs)
 
+        # Large backlogs can be moderated on several processes
+        processes = int(cfg['moderation settings'].get('processes', 1))
+        if modlists and processes > 1:
+            moderation_pool = ProcessPoolExecutor(max_workers=processes,
+                                                  initializer=_init_moderation_worker,
+                                                  initargs=(modlists,))
+
         # Get general email settings
         server = cfg['email settings']['smtp server']
         username = cfg['email settings']['smtp username']
@@ -268,34 +571,79 @@ def main(configuration_file):
         global substitutions
         substitutions = cfg['email settings']['substitutions']
 
-        # Process each service
+        # Enrichment values of repeat locations can be cached between runs
+        global enrichment_cache
+        cache_settings = cfg.get('enrichment cache')
+        if cache_settings:
+            cache_file = cache_settings.get('file', path.join(sys.path[0], 'enrichment_cache.json'))
+            enrichment_cache = EnrichmentCache(cache_file,
+                                               cache_settings.get('precision', 1.0),
+                                               cache_settings.get('max entries', 100000))
+
+        # Large services can be split into shards of ObjectIDs
+        work = []
         for service in cfg['services']:
+            shards = int(service.get('shards', 1))
+            work += [(service, shard, shards) for shard in range(shards)]
+
+        # When several workers share this configuration, each processes
+        # only the services and shards it holds a lease on
+        leases = open_leases(cfg.get('leases'))
+        if leases:
+            leases.start()
+            work = leases.acquire(work, _lease_name)
+
+        # Process each service
+        for service, shard, shards in work:
             try:
                 lyr = FeatureLayer(service['url'], gis=gis)
+                oid_field = lyr.properties.objectIdField
 
                 # GENERATE IDENTIFIERS
+                # Identifiers and enrichment are handled once per service, with the first shard
                 idseq = service['id sequence']
                 idfld = service['id field']
-                if id_settings and idseq and idfld:
-                    if idseq in id_settings:
+                if id_settings and idseq and idfld and shard == 0:
+                    if idseq not in id_settings:
+                        _add_message('Sequence {} not found in sequence settings'.format(idseq), 'WARNING')
+
+                    # workers take turns with a sequence, continuing from the last value used by any worker
+                    elif leases and not leases.lock('sequence:{}'.format(idseq)):
+                        _add_message('Sequence {} is in use by another worker'.format(idseq), 'WARNING')
+
+                    else:
+                        if leases:
+                            shared_value = leases.backend.get_value(idseq)
+                            if shared_value is not None and shared_value > id_settings[idseq]['next value']:
+                                id_settings[idseq]['next value'] = shared_value
                         new_sequence_value = add_identifiers(lyr, idseq, idfld)
+                        if new_sequence_value != id_settings[idseq]['next value']:
+                            used_sequences.add(idseq)
                         id_settings[idseq]['next value'] = new_sequence_value
-                    else:
-                        _add_message('Sequence {} not found in sequence settings'.format(idseq), 'WARNING')
+                        if leases:
+                            leases.backend.set_value(idseq, new_sequence_value)
+                            leases.release('sequence:{}'.format(idseq))
 
                 # ENRICH REPORTS
-                if service['enrichment']:
+                if service['enrichment'] and shard == 0:
                     # reversed, sorted list of enrichment settings
                     enrich_settings = sorted(service['enrichment'], key=lambda k: k['priority'])#, reverse=True)
-                    for reflayer in enrich_settings:
-                        source_features = FeatureLayer(reflayer['url'], gis)
-                        enrich_layer(source_features, lyr, reflayer)
+                    if service.get('enrichment mode') == 'single pass':
+                        enrich_service(lyr, enrich_settings, gis)
+                    else:
+                        for reflayer in enrich_settings:
+                            source_features = FeatureLayer(reflayer['url'], gis)
+                            enrich_layer(source_features, lyr, reflayer)
 
                 # MODERATION
                 if modlists:
                     for query in service['moderation']:
+                        query = _shard_settings(query, oid_field, shard, shards)
                         if query['list'] in modlists:
-                            moderate_features(lyr, query)
+                            if moderation_pool:
+                                moderate_features_parallel(lyr, query, moderation_pool, processes)
+                            else:
+                                moderate_features(lyr, query)
                         else:
                             _add_message('Moderation list {} not found in moderation settings'.format(modlist), 'WARNING')
 
@@ -303,6 +651,7 @@ def main(configuration_file):
                 if service['email']:
                     with EmailServer(server, username, password, tls) as email_server:
                         for message in service['email']:
+                            message = _shard_settings(message, oid_field, shard, shards)
                             rows = _get_features(lyr, message['sql'])
 
                             for row in rows:
@@ -316,12 +665,13 @@ def main(configuration_file):
                                                           subject=subject,
                                                           email_body=body)
 
-                                        row.attributes[message['field']] = message['sent value']
+                                        row.set_value(message['field'], message['sent value'])
                                     except:
                                         _add_message('email failed to send for feature {} in layer {}'.format(row.attributes, service['url']))
 
-                            if rows:
-                                results = lyr.edit_features(updates=rows)
+                            updates = [row.as_update(oid_field) for row in rows if row.changed]
+                            if updates:
+                                results = governor.apply_edits(lyr, updates=updates)
                                 _report_failures(results)
 
             except Exception as ex:
@@ -331,19 +681,36 @@ def main(configuration_file):
         _add_message('Failed. Please verify all configuration values\n{}'.format(ex))
 
     finally:
-        new_sequences = [{'name': seq,
-                          'interval': id_settings[seq]['interval'],
-                          'next value': id_settings[seq]['next value'],
-                          'pattern': id_settings[seq]['pattern']} for seq in id_settings]
-
-        if not new_sequences == cfg['id sequences']:
-            cfg['id sequences'] = new_sequences
+        if moderation_pool:
+            moderation_pool.shutdown()
+        if leases:
+            leases.stop()
+        if enrichment_cache and enrichment_cache.changed:
+            try:
+                enrichment_cache.save()
+            except (IOError, OSError) as ex:
+                _add_message('Failed to save enrichment cache.\n{}'.format(ex), 'WARNING')
+
+        # Only the sequences used in this run are saved, into the current contents
+        # of the file, so that runs sharing the file do not roll back each other's
+        # values. With leases, the lease store holds the latest value of each
+        # sequence and the file is only a fallback.
+        if used_sequences:
+            new_values = dict((seq, id_settings[seq]['next value']) for seq in used_sequences)
             try:
-                with open(configuration_file, 'w') as configfile:
-                    json.dump(cfg, configfile)
+                with open(configuration_file) as configfile:
+                    current = json.load(configfile)
+                for sequence in current['id sequences']:
+                    if sequence['name'] in new_values:
+                        sequence['next value'] = new_values[sequence['name']]
+
+                # write to a temporary file first so that a failure never leaves a partial file
+                with open(configuration_file + '.tmp', 'w') as configfile:
+                    json.dump(current, configfile)
+                replace(configuration_file + '.tmp', configuration_file)
 
             except Exception as ex:
-                _add_message('Failed to save identifier configuration values.\n{}\nOld values:{}\nNew values:{}'.format(ex, cfg['id sequences'], new_sequences))
+                _add_message('Failed to save identifier configuration values.\n{}\nNew values:{}'.format(ex, new_values))
 
 if __name__ == '__main__':
     main(path.join(path.dirname(__file__), 'servicefunctions.json'))